@@ -30,10 +30,17 @@ setup(
         'Flask',
 	'lxml',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+        'msgpack': ['msgpack'],
+        'redis': ['redis'],
+        'xlsx': ['XlsxWriter'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     sync-users-xml = presence_analyzer.script:sync_users
+    presence-bench = presence_analyzer.bench:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
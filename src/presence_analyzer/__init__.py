@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 """
 Main module for presence analyzer
+
+Views are not imported here, so console scripts load only what they use;
+routes of app are registered by importing presence_analyzer.views, which
+presence_analyzer.script.make_app does.
 """
 
 from .main import app
-from . import views
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control of API requests.
+"""
+from math import ceil
+from threading import Condition, Lock
+from time import time
+
+from presence_analyzer.helpers import LRUCache
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+# admission controllers by their settings
+CONTROLLERS = {}
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, up to burst at once.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time()
+        self.lock = Lock()
+
+    def take(self):
+        """
+        Takes a token if there is one.
+
+        Returns 0 when token was taken, otherwise seconds until next one.
+        """
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class AdmissionController(object):
+    """
+    Rate limits requests per client and endpoint and bounds number of
+    requests processed at once.
+
+    Requests above slots wait in a queue of given length for at most
+    timeout seconds; priority requests are let in before the others.
+    """
+
+    def __init__(self, rate=10, burst=20, slots=12, queue=12, timeout=5,
+                 clients=4096):
+        self.rate = rate
+        self.burst = burst
+        self.slots = slots
+        self.queue = queue
+        self.timeout = timeout
+        self.buckets = LRUCache(clients)
+        self.condition = Condition()
+        self.active = 0
+        # numbers of waiting requests, by priority
+        self.waiting = {False: 0, True: 0}
+
+    def limit(self, client, endpoint):
+        """
+        Takes token from bucket of client and endpoint.
+
+        Returns 0 when request is allowed, otherwise seconds to wait.
+        """
+        key = (client, endpoint)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets.set(key, bucket)
+        return bucket.take()
+
+    def acquire(self, priority=False):
+        """
+        Waits for free slot. Returns False when queue is full or timeout
+        passed, True when slot was taken and has to be released.
+        """
+        deadline = time() + self.timeout
+        with self.condition:
+            if sum(self.waiting.values()) >= self.queue and \
+                    not self.available(priority):
+                log.debug('Admission queue is full')
+                return False
+
+            self.waiting[priority] += 1
+            try:
+                while not self.available(priority):
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        log.debug('Admission timed out')
+                        return False
+                    self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def available(self, priority):
+        """
+        Tells whether request of given priority can take a slot now.
+        """
+        if self.active >= self.slots:
+            return False
+        return priority or not self.waiting[True]
+
+    def release(self):
+        """
+        Frees slot taken by acquire().
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def retry_after(self, wait=None):
+        """
+        Returns value of Retry-After header: wait or timeout in seconds.
+        """
+        return str(int(ceil(self.timeout if wait is None else wait)))
+
+
+def get_controller(config):
+    """
+    Returns admission controller configured in app config, None when
+    admission control is disabled.
+    """
+    if not config.get('ADMISSION'):
+        return None
+    settings = (
+        config.get('ADMISSION_RATE', 10),
+        config.get('ADMISSION_BURST', 20),
+        config.get('ADMISSION_SLOTS', 12),
+        config.get('ADMISSION_QUEUE', 12),
+        config.get('ADMISSION_TIMEOUT', 5),
+    )
+    controller = CONTROLLERS.get(settings)
+    if controller is None:
+        controller = CONTROLLERS.setdefault(
+            settings, AdmissionController(*settings))
+    return controller
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of suspicious presence data.
+
+Statistics are built by walking loaded data and updated from changes of
+appended loads, not while rows are read.
+"""
+import calendar
+from bisect import insort
+
+from presence_analyzer.sketches import entry_values
+
+# days with presence longer than this (in seconds) are reported
+LONG_DAY = 16 * 3600
+
+# number of latest days compared with the earlier ones of a user
+RECENT_DAYS = 10
+
+# reported shift of mean start of recent days: at least this many seconds
+# and standard deviations of earlier days
+SHIFT_SECONDS = 3600
+SHIFT_DEVIATIONS = 2
+
+# working weekdays without presence are reported for users with at least
+# this many days
+MISSING_WEEKDAYS_DAYS = 20
+
+
+class UserStats(object):
+    """
+    Statistics of one user's presence entries needed to find anomalies.
+
+    Sums of start times allow removing entries; recent holds (date, start)
+    of RECENT_DAYS latest days. Days removed from it are not replaced by
+    earlier ones, which are not kept.
+    """
+
+    def __init__(self):
+        self.days = 0
+        self.start_sum = 0.0
+        self.start_squares = 0.0
+        self.weekdays = [0] * 7
+        self.recent = []
+        # {date: seconds of presence} of days longer than LONG_DAY
+        self.long_days = {}
+
+    def copy(self):
+        """
+        Returns independent copy of stats.
+        """
+        stats = UserStats()
+        stats.days = self.days
+        stats.start_sum = self.start_sum
+        stats.start_squares = self.start_squares
+        stats.weekdays = list(self.weekdays)
+        stats.recent = list(self.recent)
+        stats.long_days = dict(self.long_days)
+        return stats
+
+    def add(self, date, entry):
+        """
+        Adds entry of given date.
+        """
+        start, _, duration = entry_values(entry)
+        self.days += 1
+        self.start_sum += start
+        self.start_squares += start * start
+        self.weekdays[date.weekday()] += 1
+        if len(self.recent) < RECENT_DAYS or date > self.recent[0][0]:
+            insort(self.recent, (date, start))
+            if len(self.recent) > RECENT_DAYS:
+                del self.recent[0]
+        if duration > LONG_DAY:
+            self.long_days[date] = duration
+
+    def remove(self, date, entry):
+        """
+        Removes entry of given date added before.
+        """
+        start, _, _ = entry_values(entry)
+        self.days -= 1
+        self.start_sum -= start
+        self.start_squares -= start * start
+        self.weekdays[date.weekday()] -= 1
+        if (date, start) in self.recent:
+            self.recent.remove((date, start))
+        self.long_days.pop(date, None)
+
+    def shift(self):
+        """
+        Returns (recent, earlier) mean start in seconds when start of
+        recent days differs from earlier ones, otherwise None.
+        """
+        earlier_days = self.days - len(self.recent)
+        if len(self.recent) < RECENT_DAYS or earlier_days < RECENT_DAYS:
+            return None
+
+        recent_sum = sum(start for _, start in self.recent)
+        recent_squares = sum(start * start for _, start in self.recent)
+        recent = recent_sum / len(self.recent)
+        earlier = (self.start_sum - recent_sum) / earlier_days
+        variance = (self.start_squares - recent_squares) / earlier_days - \
+            earlier * earlier
+        deviation = max(variance, 0) ** 0.5
+        if abs(recent - earlier) < max(SHIFT_SECONDS,
+                                       SHIFT_DEVIATIONS * deviation):
+            return None
+        return int(recent), int(earlier)
+
+    def missing_weekdays(self):
+        """
+        Returns working weekdays (0 is Monday) without presence.
+        """
+        if self.days < MISSING_WEEKDAYS_DAYS:
+            return []
+        return [weekday for weekday in range(5) if not self.weekdays[weekday]]
+
+
+class PresenceAnomalies(object):
+    """
+    Anomaly statistics of each user, together with rows rejected by
+    loader because of ending before start.
+
+    structure:
+        users[user_id] = <UserStats>
+        rejected = [(line, text)]
+    """
+
+    def __init__(self, users=None, rejected=()):
+        self.users = users or {}
+        self.rejected = list(rejected)
+        # number of rejected rows of data checked so far
+        self.checked = 0
+
+    @classmethod
+    def build(cls, items, rejected=()):
+        """
+        Creates statistics of (user_id, user_data) items and rejected
+        (line, reason, text) rows.
+        """
+        anomalies = cls()
+        for user_id, user_data in items:
+            for date, entry in user_data.items():
+                anomalies.add(user_id, date, entry)
+        anomalies.check(rejected)
+        return anomalies
+
+    def check(self, rejected):
+        """
+        Collects rows rejected because of ending before start from given
+        (line, reason, text) rows.
+        """
+        self.checked += len(rejected)
+        self.rejected.extend(
+            (line, text) for line, reason, text in rejected
+            if reason == 'end_before_start'
+        )
+
+    def add(self, user_id, date, entry):
+        """
+        Adds entry of user.
+        """
+        stats = self.users.get(user_id)
+        if stats is None:
+            stats = self.users[user_id] = UserStats()
+        stats.add(date, entry)
+
+    def remove(self, user_id, date, entry):
+        """
+        Removes entry of user added before.
+        """
+        self.users[user_id].remove(date, entry)
+
+    def updated(self, changes, rejected=()):
+        """
+        Returns statistics with given (user_id, date, old, new) changes
+        applied and newly rejected rows checked.
+
+        Statistics of changed users are copied, so self stays untouched.
+        """
+        users = dict(self.users)
+        anomalies = PresenceAnomalies(users, self.rejected)
+        anomalies.checked = self.checked
+        anomalies.check(rejected)
+        copied = set()
+        for user_id, date, old, new in changes:
+            if user_id not in copied:
+                if user_id in self.users:
+                    users[user_id] = self.users[user_id].copy()
+                copied.add(user_id)
+            if old is not None:
+                anomalies.remove(user_id, date, old)
+            anomalies.add(user_id, date, new)
+        return anomalies
+
+    def report(self):
+        """
+        Returns found anomalies: long days, rejected rows ending before
+        start, shifts of start time and missing weekdays.
+        """
+        result = {
+            'long_days': [],
+            'end_before_start': [
+                {'line': line, 'row': text} for line, text in self.rejected
+            ],
+            'pattern_shifts': [],
+            'missing_weekdays': [],
+        }
+        for user_id in sorted(self.users):
+            stats = self.users[user_id]
+            for date in sorted(stats.long_days):
+                result['long_days'].append({
+                    'user_id': user_id,
+                    'date': date.isoformat(),
+                    'hours': round(stats.long_days[date] / 3600.0, 2),
+                })
+            shift = stats.shift()
+            if shift is not None:
+                result['pattern_shifts'].append({
+                    'user_id': user_id,
+                    'recent_start': format_seconds(shift[0]),
+                    'usual_start': format_seconds(shift[1]),
+                })
+            missing = stats.missing_weekdays()
+            if missing:
+                result['missing_weekdays'].append({
+                    'user_id': user_id,
+                    'weekdays': [calendar.day_abbr[i] for i in missing],
+                })
+        return result
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM.
+    """
+    return '%02d:%02d' % (seconds // 3600, seconds % 3600 // 60)
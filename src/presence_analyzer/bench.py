@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks.
+"""
+# pylint:skip-file
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+# code doing what each entry point does before its actual work
+STARTUP = (
+    ('flask-ctl', 'import sys; sys.argv = ["flask-ctl", "--help"]; '
+                  'from presence_analyzer.script import run; run()'),
+    ('sync-users-xml', 'import urllib2, flask; '
+                       'from presence_analyzer.script import sync_users'),
+    ('presence-bench', 'import sys; sys.argv = ["presence-bench", "--help"]; '
+                       'from presence_analyzer.bench import run; run()'),
+    ('paster app', 'from presence_analyzer.script import make_app; '
+                   'from presence_analyzer import views'),
+)
+
+
+# chart pages of the dashboard, each requests its endpoint per picked user
+CHARTS = ('mean_time_weekday', 'presence_weekday', 'presence_start_end')
+
+# app config used by load test
+LOAD_CONFIG = """
+DEBUG = False
+DATA_CSV = %(data_csv)r
+DATA_XML = %(data_xml)r
+WARM_UP = False
+ADMISSION = %(admission)r
+"""
+
+
+def generate_csv(path, users=100, days=3650, seed=0):
+    """Write random presence CSV file with users * days rows."""
+    rand = random.Random(seed)
+    first_day = date(2005, 1, 1)
+    with open(path, 'w') as csvfile:
+        for user_id in range(users):
+            for day in range(days):
+                start = rand.randint(7 * 3600, 11 * 3600)
+                end = start + rand.randint(3600, 10 * 3600)
+                csvfile.write('%d,%s,%02d:%02d:%02d,%02d:%02d:%02d\n' % (
+                    user_id, first_day + timedelta(days=day),
+                    start // 3600, start % 3600 // 60, start % 60,
+                    end // 3600, end % 3600 // 60, end % 60,
+                ))
+
+
+def generate_users_xml(path, users=100):
+    """Write users XML file with users of generate_csv()."""
+    with open(path, 'w') as xmlfile:
+        xmlfile.write('<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>'
+                      '<server><host>localhost</host><port>443</port>'
+                      '<protocol>https</protocol></server><users>\n')
+        for user_id in range(users):
+            xmlfile.write(
+                '<user id="%d"><avatar>/api/images/users/%d</avatar>'
+                '<name>User %d</name></user>\n' % (user_id, user_id, user_id))
+        xmlfile.write('</users></intranet>\n')
+
+
+def best_of(repeat, func, *args):
+    """Best wall time of repeat calls of func."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def bench_parse(path, workers=(1, 2, 4, 8), repeat=3):
+    """Time parsing and merging of path with each number of workers.
+
+    Merging runs in the parent process only, so its share of single worker
+    time (serial) bounds the speedup of more workers (Amdahl's law).
+    """
+    from multiprocessing import cpu_count
+    from presence_analyzer.storage import parse_csv, merge_chunks, \
+        get_pool
+
+    print 'file: %s (%.1f MB), CPUs: %d (workers are capped to them)' % (
+        path, os.path.getsize(path) / 1e6, cpu_count())
+    print '%8s %10s %10s %10s %8s %8s' % ('workers', 'parse', 'merge',
+                                          'total', 'serial', 'speedup')
+    base = serial = None
+    for count in workers:
+        get_pool(count)  # started once per process, like the app does
+        parse = best_of(repeat, parse_csv, path, count)
+        chunks = parse_csv(path, count)
+        merge = best_of(repeat, merge_chunks, chunks)
+        base = base or parse + merge
+        serial = serial or merge / (parse + merge)
+        print '%8d %10.3f %10.3f %10.3f %7.1f%% %7.2fx' % (
+            count, parse, merge, parse + merge,
+            100 * merge / (parse + merge), base / (parse + merge))
+    print 'serial fraction %.1f%% bounds speedup to %.1fx' % (
+        100 * serial, 1 / serial)
+
+
+def start_python(code):
+    """Run code in new Python process, ignoring its output."""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-c', code],
+                              stdout=devnull, stderr=devnull)
+
+
+def bench_startup(repeat=5):
+    """Time startup of each entry point in new Python process."""
+    base = best_of(repeat, start_python, 'pass')
+    print '%-16s %10s %10s' % ('entry point', 'seconds', 'imports')
+    print '%-16s %10.3f %10s' % ('python', base, '-')
+    for name, code in STARTUP:
+        seconds = best_of(repeat, start_python, code)
+        print '%-16s %10.3f %10.3f' % (name, seconds, seconds - base)
+
+
+def percentile(values, percent):
+    """Value of sorted values below which given percent of them are."""
+    if not values:
+        return float('nan')
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def expire_caches():
+    """Drop cached presence data and users, as if their cache expired."""
+    from presence_analyzer.caches import MemoryCache
+    from presence_analyzer.decorators import set_cache_backend
+    from presence_analyzer.storage import clear_caches
+
+    set_cache_backend(MemoryCache())
+    clear_caches()
+
+
+def serve(app, workers, spawn_if_under, max_requests):
+    """Start paste server of app on free local port in background thread."""
+    import paste.httpserver
+    import threading
+
+    server = paste.httpserver.serve(
+        app, host='127.0.0.1', port='0', start_loop=False,
+        use_threadpool=True, threadpool_workers=workers,
+        threadpool_options={'spawn_if_under': spawn_if_under,
+                            'max_requests': max_requests})
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, thread
+
+
+def dashboard_session(url, users, deadline, results, seed):
+    """Replay dashboard traffic till deadline, collect (seconds, ok).
+
+    Each visit opens one chart page, which loads users for dropdown, and
+    then picks three users from it.
+    """
+    import urllib2
+
+    rand = random.Random(seed)
+    while time.time() < deadline:
+        chart = rand.choice(CHARTS)
+        paths = ['/api/v1/users'] + [
+            '/api/v1/%s/%d' % (chart, rand.randrange(users))
+            for _ in range(3)
+        ]
+        for path in paths:
+            start = time.time()
+            try:
+                urllib2.urlopen(url + path, timeout=60).read()
+                ok = True
+            except Exception:
+                ok = False
+            results.append((time.time() - start, ok))
+
+
+def bench_load(data_csv, data_xml, users, configs, clients=20, duration=10,
+               expire=5, admission=False):
+    """Load test app served by paste with each threadpool config.
+
+    Configs are (workers, spawn_if_under, max_requests) tuples. Every
+    expire seconds cached data is dropped, so some requests hit reload.
+    """
+    import threading
+    from presence_analyzer.script import make_app
+
+    handle, config = tempfile.mkstemp(suffix='.cfg')
+    with os.fdopen(handle, 'w') as config_file:
+        config_file.write(LOAD_CONFIG % {'data_csv': data_csv,
+                                         'data_xml': data_xml,
+                                         'admission': admission})
+    try:
+        app = make_app(config=config, warm_up=False)
+    finally:
+        os.remove(config)
+
+    print '%8s %6s %8s %9s %8s %8s %8s %7s' % (
+        'workers', 'spawn', 'max_req', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms', 'errors')
+    for workers, spawn_if_under, max_requests in configs:
+        expire_caches()
+        server, server_thread = serve(app, workers, spawn_if_under,
+                                      max_requests)
+        url = 'http://127.0.0.1:%d' % server.server_port
+        results = []
+        start = time.time()
+        deadline = start + duration
+        threads = [
+            threading.Thread(target=dashboard_session,
+                             args=(url, users, deadline, results, seed))
+            for seed in range(clients)
+        ]
+        for thread in threads:
+            thread.start()
+        while time.time() + expire < deadline:
+            time.sleep(expire)
+            expire_caches()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        server.running = False
+        server_thread.join()
+        server.server_close()
+
+        latencies = sorted(seconds * 1000 for seconds, _ in results)
+        errors = sum(1 for _, ok in results if not ok)
+        print '%8d %6d %8d %9.1f %8.1f %8.1f %8.1f %6.2f%%' % (
+            workers, spawn_if_under, max_requests,
+            len(results) / elapsed, percentile(latencies, 50),
+            percentile(latencies, 95), percentile(latencies, 99),
+            100.0 * errors / max(len(results), 1))
+
+
+# bin/presence-bench ...
+def run():
+    import werkzeug.script
+
+    # bin/presence-bench parse [--path=...] [--workers=1,2,4,8]
+    def action_parse(path=('p', ''), workers=('w', '1,2,4,8'),
+                     repeat=('r', 3), users=('u', 100), days=('d', 3650)):
+        """Benchmark parallel parsing of presence CSV.
+
+        Without --path a random file with users * days rows is generated.
+        """
+        workers = [int(i) for i in workers.split(',')]
+        if path:
+            bench_parse(path, workers, repeat)
+            return
+
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            generate_csv(path, users, days)
+            bench_parse(path, workers, repeat)
+        finally:
+            os.remove(path)
+
+    # bin/presence-bench startup [--repeat=5]
+    def action_startup(repeat=('r', 5)):
+        """Benchmark startup time of console scripts and the app.
+
+        Each entry point is started in new Python process, "imports"
+        column is the time above bare interpreter startup.
+        """
+        bench_startup(repeat)
+
+    # bin/presence-bench load [--configs=10:5:200,50:5:200] [--clients=20]
+    def action_load(configs=('c', '10:5:200,50:5:200'), clients=('n', 20),
+                    duration=('t', 10), expire=('e', 5), users=('u', 100),
+                    days=('d', 365), admission=False):
+        """Load test the app served by paste with dashboard traffic.
+
+        Configs are comma separated workers:spawn_if_under:max_requests
+        of paste threadpool (see deploy_ini in buildout.cfg). Data of
+        users * days rows is generated; cached data is dropped every
+        --expire seconds. Reports throughput, latency percentiles and
+        error rate of each config.
+        """
+        configs = [tuple(int(i) for i in config.split(':'))
+                   for config in configs.split(',')]
+        tmp_dir = tempfile.mkdtemp()
+        data_csv = os.path.join(tmp_dir, 'presence.csv')
+        data_xml = os.path.join(tmp_dir, 'users.xml')
+        try:
+            generate_csv(data_csv, users, days)
+            generate_users_xml(data_xml, users)
+            bench_load(data_csv, data_xml, users, configs, clients,
+                       duration, expire, admission)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    werkzeug.script.run()
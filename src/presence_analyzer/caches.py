@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Backends of decorators.cache.
+"""
+import cPickle as pickle
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from threading import Lock
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+def dumps(value):
+    """
+    Serializes value compactly: pickled with protocol 2 and compressed.
+    """
+    return zlib.compress(pickle.dumps(value, 2), 1)
+
+
+def loads(value):
+    """
+    Deserializes value serialized by dumps().
+    """
+    return pickle.loads(zlib.decompress(value))
+
+
+class MemoryCache(object):
+    """
+    Cache in memory of the process, values are kept as they are.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.locks = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        """
+        Returns value of key, None when it is missing.
+        """
+        return self.values.get(key)
+
+    def set(self, key, value, timeout):  # pylint: disable=W0613
+        """
+        Stores value of key. Memory cache keeps it after timeout too,
+        decorators.cache tells expired values itself.
+        """
+        with self.lock:
+            self.values[key] = value
+
+    @contextmanager
+    def locked(self, key):
+        """
+        Holds lock of key, so only one thread computes its value.
+        """
+        with self.lock:
+            lock = self.locks.setdefault(key, Lock())
+        with lock:
+            yield
+
+
+class RedisCache(object):
+    """
+    Cache in Redis server shared by all processes of the app.
+
+    Values are serialized with dumps(). Next to each value a short stamp
+    is stored, so a process checks the stamp on every get and transfers
+    and deserializes the value only when it changed.
+    """
+
+    # seconds the lock of key is held at most, and waited for at most
+    LOCK_TIMEOUT = 120
+
+    # deletes lock (KEYS[1]) only if it still holds token (ARGV[1])
+    RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, client, prefix='presence_analyzer:'):
+        self.client = client
+        self.prefix = prefix
+        # values deserialized by this process: {key: (stamp, value)}
+        self.local = {}
+
+    @classmethod
+    def from_url(cls, url):
+        """
+        Creates backend connected to server at redis:// URL.
+        """
+        return cls(import_redis().StrictRedis.from_url(url))
+
+    def get(self, key):
+        """
+        Returns value of key, None when it is missing.
+        """
+        stamp = self.client.get(self.prefix + 'stamp:' + key)
+        if stamp is None:
+            return None
+        local = self.local.get(key)
+        if local is not None and local[0] == stamp:
+            return local[1]
+
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return None
+        value = loads(data)
+        self.local[key] = (stamp, value)
+        return value
+
+    def set(self, key, value, timeout):
+        """
+        Stores value of key for timeout seconds.
+        """
+        stamp = uuid.uuid4().hex
+        self.client.set(self.prefix + key, dumps(value), ex=timeout)
+        self.client.set(self.prefix + 'stamp:' + key, stamp, ex=timeout)
+        self.local[key] = (stamp, value)
+
+    @contextmanager
+    def locked(self, key):
+        """
+        Holds lock of key shared by all processes, so only one of them
+        computes its value. When lock is not released in LOCK_TIMEOUT
+        seconds, it is taken over; the lock is released atomically only
+        when it was not taken over, so lock of other process is kept.
+        """
+        name = self.prefix + 'lock:' + key
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.LOCK_TIMEOUT
+        while not self.client.set(name, token, nx=True,
+                                  ex=self.LOCK_TIMEOUT):
+            if time.time() > deadline:
+                log.warning('Taking over lock of %s', key)
+                self.client.set(name, token, ex=self.LOCK_TIMEOUT)
+                break
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            self.client.eval(self.RELEASE_SCRIPT, 1, name, token)
+
+
+def import_redis():
+    """
+    Imports redis client, which is needed for Redis cache backend only.
+    """
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError('redis is required for Redis cache backend')
+    return redis
+
+
+def make_cache(config):
+    """
+    Creates cache backend configured in app config: CACHE_URL of Redis
+    server, in-memory cache without it.
+    """
+    url = config.get('CACHE_URL')
+    if url:
+        return RedisCache.from_url(url)
+    return MemoryCache()
@@ -4,22 +4,117 @@ Decorators
 """
 from functools import wraps
 from datetime import datetime, timedelta
-from threading import Lock
+from threading import Event, Lock
 import logging
+from presence_analyzer.caches import MemoryCache
 from presence_analyzer.helpers import generate_cache_key
 
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
+# backend of cache(), see set_cache_backend()
+BACKEND = MemoryCache()
+
+
+def set_cache_backend(new_backend):
+    """
+    Sets backend storing values of all functions decorated with cache().
+    """
+    global BACKEND  # pylint: disable=W0603
+    BACKEND = new_backend
+
 
 def cache(time=60*60):
     """
-    Cache in local mem for given time
+    Cache in backend (local mem by default) for given time
+
+    Wrapped function gets a ``refresh`` attribute which recomputes the value
+    and swaps it in, regardless of its expiry time, ``expired`` telling
+    whether the next call will recompute it and ``age`` telling seconds
+    since the value was stored.
+
+    Values are recomputed under lock of the backend. Expired ones are not
+    recomputed when other caller stored them meanwhile, and refreshed ones
+    when other caller stored them after the refresh started, so shared
+    backend computes them once for all processes.
+    """
+
+    # structure of stored values:
+    #   {'valid_till': <datetime.datetime>, 'stored': <datetime.datetime>,
+    #    'data': <dict>}
+
+    def decorator(func):
+
+        def load(key, args, kwargs, force):
+            """ Recomputes value under lock, unless other one did it """
+            started = datetime.now()
+            with BACKEND.locked(key):
+                cached = BACKEND.get(key)
+                if cached is not None:
+                    if not force and cached['valid_till'] > datetime.now():
+                        return cached['data']
+                    if force and cached.get('stored', started) > started:
+                        log.debug('Cache for %s was refreshed meanwhile' %
+                                  key)
+                        return cached['data']
+
+                log.debug('Refreshing cache for %s' % key)
+                data = func(*args, **kwargs)
+                now = datetime.now()
+                BACKEND.set(key, {
+                    'valid_till': now+timedelta(seconds=time),
+                    'stored': now,
+                    'data': data
+                }, time)
+                return data
+
+        def refresh(*args, **kwargs):
+            """ Recomputes value and stores it in cache """
+            key = generate_cache_key(func, args, kwargs)
+            return load(key, args, kwargs, True)
+
+        def expired(*args, **kwargs):
+            """ Tells whether value is missing or expired """
+            cached = BACKEND.get(generate_cache_key(func, args, kwargs))
+            return cached is None or cached['valid_till'] <= datetime.now()
+
+        def age(*args, **kwargs):
+            """ Returns seconds since value was stored, None if missing """
+            cached = BACKEND.get(generate_cache_key(func, args, kwargs))
+            if cached is None or 'stored' not in cached:
+                return None
+            return (datetime.now() - cached['stored']).total_seconds()
+
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            """ Wrapper """
+            key = generate_cache_key(func, args, kwargs)
+            cached = BACKEND.get(key)
+            if cached is None or cached['valid_till'] <= datetime.now():
+                return load(key, args, kwargs, False)
+
+            log.debug('Retrieving from cache %s' % key)
+            return cached['data']
+
+        wrapped_function.refresh = refresh
+        wrapped_function.expired = expired
+        wrapped_function.age = age
+        return wrapped_function
+
+    return decorator
+
+
+def cache_for(source):
+    """
+    Cache in local mem for as long as source() returns the same value.
+
+    Result of source() is passed to wrapped function as first argument, so
+    cached values are always computed from the object they are tied to.
     """
 
     # structure:
-    #   indexes are generated keys
-    #   value is dict: {'valid_till': <datetime.datetime>, 'data': <dict>}
-    cached_data = {}
+    #   'source' is the last value returned by source()
+    #   'data' is dict indexed by generated keys
+    cached = {'source': None, 'data': {}}
     lock = Lock()
 
     def decorator(func):
@@ -27,23 +122,115 @@ def cache(time=60*60):
         @wraps(func)
         def wrapped_function(*args, **kwargs):
             """ Wrapper """
+            current = source()
+            with lock:
+                if cached['source'] != current:
+                    log.debug('Source of %s changed' % func.__name__)
+                    cached['source'] = current
+                    cached['data'] = {}
+                values = cached['data']
+
             key = generate_cache_key(func, args, kwargs)
+            if key not in values:
+                values[key] = func(current, *args, **kwargs)
 
-            refresh_key = (
-                key not in cached_data or
-                (cached_data[key]['valid_till']-datetime.now()).seconds <= 0
-            )
-            if refresh_key:
-                log.debug('Refreshing cache for %s' % key)
+            return values[key]
+
+        return wrapped_function
+
+    return decorator
+
+
+def cache_updates(source):
+    """
+    Cache in local mem value derived from source(), which is versioned.
+
+    Wrapped function gets source() value, together with version and value
+    cached for previous one (None at first), so it can update that value
+    instead of computing it from scratch.
+    """
+
+    # structure: {'version': <version of source>, 'data': <cached value>}
+    cached = {'version': None, 'data': None}
+    lock = Lock()
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapped_function():
+            """ Wrapper """
+            current = source()
+            with lock:
+                if cached['data'] is None or \
+                        cached['version'] != current.version:
+                    log.debug('Updating %s' % func.__name__)
+                    cached['data'] = func(current, cached['version'],
+                                          cached['data'])
+                    cached['version'] = current.version
+                return cached['data']
+
+        return wrapped_function
+
+    return decorator
+
+
+def coalesce(source, time=5):
+    """
+    Share result between identical concurrent calls, cache it for given time.
+
+    Calls are identical when they have the same arguments and source()
+    returns the same value. The first call computes the result while the
+    others wait for it; if it fails, they compute it themselves.
+    """
+
+    # structure:
+    #   cached_data: {(source, key): {'valid_till': <datetime>, 'data': ..}}
+    #   pending: {(source, key): <threading.Event set when computed>}
+    cached_data = {}
+    pending = {}
+    lock = Lock()
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            """ Wrapper """
+            key = (source(), generate_cache_key(func, args, kwargs))
+            with lock:
+                now = datetime.now()
+                if key in cached_data and \
+                        cached_data[key]['valid_till'] > now:
+                    return cached_data[key]['data']
+                event = pending.get(key)
+                if event is None:
+                    event = pending[key] = Event()
+                    waiting = False
+                else:
+                    waiting = True
+
+            if waiting:
+                log.debug('Waiting for %s' % key[1])
+                event.wait()
                 with lock:
+                    if key in cached_data:
+                        return cached_data[key]['data']
+                return func(*args, **kwargs)
+
+            try:
+                data = func(*args, **kwargs)
+                with lock:
+                    for expired in [k for k, v in cached_data.items()
+                                    if v['valid_till'] <= now]:
+                        del cached_data[expired]
                     cached_data[key] = {
-                        'valid_till': datetime.now()+timedelta(seconds=time),
-                        'data': func(*args, **kwargs)
+                        'valid_till': now + timedelta(seconds=time),
+                        'data': data
                     }
-            else:
-                log.debug('Retrieving from cache %s' % key)
-
-            return cached_data[key]['data']
+            finally:
+                with lock:
+                    del pending[key]
+                event.set()
+            return data
 
         return wrapped_function
 
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Export of daily presence entries.
+"""
+
+import csv
+import os
+import tempfile
+
+from presence_analyzer.utils import get_user_data, get_user_ids, \
+    presence_time
+
+# columns of exported rows
+COLUMNS = ('user_id', 'date', 'start', 'end', 'duration')
+
+# rows written per yielded chunk of CSV
+CSV_BATCH = 1000
+
+
+def import_xlsxwriter():
+    """
+    Imports xlsxwriter, returns None when it is not installed.
+    """
+    try:
+        import xlsxwriter
+    except ImportError:
+        return None
+    return xlsxwriter
+
+
+# xlsxwriter module needed by XLSX export, None when it is not installed
+xlsxwriter = import_xlsxwriter()  # pylint: disable=C0103
+
+
+def export_rows(user_ids=None, start=None, end=None):
+    """
+    Generates (user_id, date, start, end, duration) rows of given users
+    (all by default) between start and end dates, user by user.
+    """
+    if not user_ids:
+        user_ids = sorted(get_user_ids())
+
+    for user_id in user_ids:
+        user_data = get_user_data(user_id, start, end)
+        for date in sorted(user_data):
+            row = user_data[date]
+            yield (user_id, date.isoformat(), row['start'].isoformat(),
+                   row['end'].isoformat(), presence_time(row))
+
+
+class LineBuffer(object):
+    """
+    File-like object which returns written data instead of storing it.
+    """
+
+    def write(self, value):  # pylint: disable=R0201
+        """
+        Returns given value.
+        """
+        return value
+
+
+def csv_chunks(rows):
+    """
+    Generates CSV file with header and given rows in chunks.
+    """
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(COLUMNS)
+
+    batch = []
+    for row in rows:
+        batch.append(writer.writerow(row))
+        if len(batch) >= CSV_BATCH:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def xlsx_chunks(rows, chunk_size=64*1024):
+    """
+    Generates XLSX file with header and given rows in chunks.
+
+    Workbook is written row by row to temporary file in xlsxwriter's
+    constant memory mode and then streamed from it.
+    """
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        sheet = workbook.add_worksheet('Presence')
+        sheet.write_row(0, 0, COLUMNS)
+        for i, row in enumerate(rows, 1):
+            sheet.write_row(i, 0, row)
+        workbook.close()
+
+        with open(path, 'rb') as xlsx_file:
+            for chunk in iter(lambda: xlsx_file.read(chunk_size), ''):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+# export formats by extension: (mimetype, chunks generator)
+FORMATS = {
+    'csv': ('text/csv', csv_chunks),
+    'xlsx': (
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        xlsx_chunks,
+    ),
+}
+
+
+def missing_package(extension):
+    """
+    Returns name of package needed by export format of given extension
+    which is not installed, None when format can be used.
+    """
+    if extension == 'xlsx' and xlsxwriter is None:
+        return 'XlsxWriter'
+    return None
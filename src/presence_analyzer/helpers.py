@@ -2,6 +2,8 @@
 """
 Helper functions used in templates.
 """
+from collections import OrderedDict
+from threading import Lock
 
 
 def generate_cache_key(func, args, kwargs):
@@ -10,3 +12,95 @@ def generate_cache_key(func, args, kwargs):
     """
     return '%s.%s:%s:%s' % (func.__module__, func.__name__, args.__hash__(),
                             frozenset(kwargs.items()).__hash__())
+
+
+def to_bytes(value):
+    """
+    Returns value as byte string, unicode is encoded in UTF-8.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class Serialized(str):
+    """
+    JSON document which is already encoded and can be sent as it is.
+    """
+
+
+class VersionedDict(dict):
+    """
+    Dict tagged with version of the data it was loaded from.
+    """
+
+    def __init__(self, data=(), version=None):
+        super(VersionedDict, self).__init__(data)
+        self.version = version
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping which keeps up to size most recently used items.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns value of key and marks it as recently used.
+        """
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Stores value, dropping least recently used items above size.
+        """
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        """
+        Drops all items.
+        """
+        with self.lock:
+            self.items.clear()
+
+
+class Slots(object):
+    """
+    Thread-safe counter of slots taken at once, up to given limit.
+    """
+
+    def __init__(self):
+        self.taken = 0
+        self.lock = Lock()
+
+    def take(self, limit):
+        """
+        Takes slot if fewer than limit are taken. Returns whether it did.
+        """
+        with self.lock:
+            if self.taken >= limit:
+                return False
+            self.taken += 1
+            return True
+
+    def release(self):
+        """
+        Frees slot taken by take().
+        """
+        with self.lock:
+            self.taken -= 1
@@ -2,13 +2,12 @@
 """Startup utilities"""
 # pylint:skip-file
 
+# Only modules needed by every entry point are imported here, the rest is
+# imported by functions which use it.
 import os
+import signal
 import sys
 from functools import partial
-import urllib2
-
-import paste.script.command
-import werkzeug.script
 
 etc = partial(os.path.join, 'parts', 'etc')
 
@@ -27,13 +26,41 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm_up=True):
+    from presence_analyzer.main import app
+    from presence_analyzer import views  # registers routes
+    from presence_analyzer.utils import start_warm_up, handle_sighup
+    from presence_analyzer.caches import make_cache
+    from presence_analyzer.decorators import set_cache_backend
+    from presence_analyzer.storage import get_pool, USER_CACHE
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    set_cache_backend(make_cache(app.config))
+    USER_CACHE.size = app.config.get('DATA_CSV_CACHE_USERS', USER_CACHE.size)
+    # fork CSV parsing processes before any server thread is started
+    get_pool(app.config.get('DATA_CSV_WORKERS', 0))
+    if warm_up and app.config.get('WARM_UP'):
+        start_warm_up(
+            workers=app.config.get('WARM_UP_WORKERS', 0),
+            interval=app.config.get('WARM_UP_INTERVAL'),
+        )
+    if warm_up and hasattr(signal, 'SIGHUP'):
+        # kill -HUP reloads presence data and users
+        try:
+            signal.signal(signal.SIGHUP, handle_sighup)
+        except ValueError:
+            pass  # not called from main thread
     return app
 
 
+def load_config(config=DEPLOY_CFG):
+    """Read app config without setting up the app."""
+    from flask import Config
+    loaded = Config(abspath())
+    loaded.from_pyfile(abspath(config))
+    return loaded
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
@@ -45,7 +72,7 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = make_app(warm_up=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -68,6 +95,7 @@ def _serve(action, debug=False, dry_run=False):
     print ' '.join(argv)
     if dry_run:
         return
+    import paste.script.command
     # Configure logging and lock file
     if action in ('start', 'stop', 'restart', 'status'):
         argv += [
@@ -81,6 +109,8 @@ def _serve(action, debug=False, dry_run=False):
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
+
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
@@ -111,13 +141,91 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl import_sqlite [--path=...]
+    def action_import_sqlite(path=('p', '')):
+        """Import presence CSV file into SQLite database.
+
+        Imports DATA_CSV (or file given with --path) into DATA_DB,
+        replacing its previous contents.
+        """
+        from presence_analyzer.storage import SQLiteStorage
+        config = load_config()
+        path = path or config['DATA_CSV']
+        count = SQLiteStorage(config['DATA_DB']).import_csv(path)
+        print 'Imported %d rows from %s into %s' % (
+            count, path, config['DATA_DB'])
+
+    # bin/flask-ctl export_arrow --path=...
+    def action_export_arrow(path=('p', '')):
+        """Convert presence CSV file into Parquet or Arrow IPC file.
+
+        Converts DATA_CSV into file given with --path; its extension
+        (.parquet or .arrow) selects format. Point DATA_CSV to the new
+        file to use it.
+        """
+        from presence_analyzer.storage import export_arrow
+        config = load_config()
+        count = export_arrow(config['DATA_CSV'], path)
+        print 'Exported %d rows from %s into %s' % (
+            count, config['DATA_CSV'], path)
+
+    # bin/flask-ctl index_csv
+    def action_index_csv():
+        """Build offset index of presence CSV file.
+
+        Writes index of DATA_CSV used by "indexed_csv" storage next to it.
+        """
+        from presence_analyzer.storage import build_index, write_index, \
+            index_path
+        config = load_config()
+        index = build_index(config['DATA_CSV'])
+        write_index(config['DATA_CSV'], index)
+        print 'Indexed %d users of %s into %s' % (
+            len(index['users']), config['DATA_CSV'],
+            index_path(config['DATA_CSV']))
+
+    # bin/flask-ctl export --path=... [--users=...] [--start=...] [--end=...]
+    def action_export(path=('p', ''), users=('u', ''), start=('s', ''),
+                      end=('e', '')):
+        """Export daily presence entries into CSV or XLSX file.
+
+        Format is chosen by --path extension. Users are given as comma
+        separated ids (all by default), dates as YYYY-MM-DD (inclusive).
+        """
+        from datetime import datetime
+        from presence_analyzer import export
+
+        def parse_date(value):
+            if value:
+                return datetime.strptime(value, '%Y-%m-%d').date()
+
+        extension = os.path.splitext(path)[1][1:]
+        if extension not in export.FORMATS:
+            sys.exit('Unsupported --path extension "%s", use one of: %s' % (
+                extension, ', '.join(sorted(export.FORMATS))))
+        package = export.missing_package(extension)
+        if package is not None:
+            sys.exit('%s is required for .%s export' % (package, extension))
+
+        make_app(warm_up=False)
+        chunks = export.FORMATS[extension][1]
+        rows = export.export_rows(
+            [int(i) for i in users.split(',') if i],
+            parse_date(start), parse_date(end))
+        with open(path, 'wb') as export_file:
+            for chunk in chunks(rows):
+                export_file.write(chunk)
+        print 'Exported presence entries into %s' % path
+
     werkzeug.script.run()
 
 
 # bin/sync-users-xml
 def sync_users():
     """ Fetch users data """
-    config = make_app().config
+    import urllib2
+
+    config = load_config()
     request = urllib2.Request(config['DATA_URL'])
 
     try:
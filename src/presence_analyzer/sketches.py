@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of presence times.
+"""
+
+# metrics sketched for each user and weekday
+METRICS = ('start', 'end', 'duration')
+
+
+def entry_values(entry):
+    """
+    Returns start, end and duration of entry in seconds.
+
+    Duration of day with several intervals covers only the intervals.
+    """
+    start = entry['start']
+    end = entry['end']
+    start = start.hour * 3600 + start.minute * 60 + start.second
+    end = end.hour * 3600 + end.minute * 60 + end.second
+    if 'intervals' in entry:
+        return start, end, entry['intervals'].duration()
+    return start, end, end - start
+
+
+class Histogram(object):
+    """
+    Fixed-bin histogram of seconds, with one minute bins.
+
+    Histograms can be merged and have values removed, quantiles are
+    interpolated within bins, so they are exact to a minute.
+    """
+
+    BIN = 60
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+        self.total = sum(self.counts.values())
+
+    def add(self, value, count=1):
+        """
+        Adds count of value (removes it for negative count).
+        """
+        key = value // self.BIN
+        current = self.counts.get(key, 0) + count
+        if current:
+            self.counts[key] = current
+        else:
+            del self.counts[key]
+        self.total += count
+
+    def remove(self, value):
+        """
+        Removes single value added before.
+        """
+        self.add(value, -1)
+
+    def merge(self, other):
+        """
+        Adds all values of other histogram.
+        """
+        for key, count in other.counts.items():
+            self.add(key * self.BIN, count)
+
+    def copy(self):
+        """
+        Returns independent copy of histogram.
+        """
+        return Histogram(self.counts)
+
+    def quantile(self, fraction):
+        """
+        Returns value below which given fraction of values lays.
+        """
+        if not self.total:
+            return 0
+
+        rank = fraction * self.total
+        seen = 0
+        for key in sorted(self.counts):
+            count = self.counts[key]
+            if seen + count >= rank:
+                return int((key + float(rank - seen) / count) * self.BIN)
+            seen += count
+        return (max(self.counts) + 1) * self.BIN
+
+
+class PresenceSketches(object):
+    """
+    Histograms of start, end and duration of each user by weekday.
+
+    structure:
+        users[user_id][weekday][metric] = <Histogram>
+    """
+
+    def __init__(self, users=None):
+        self.users = users or {}
+
+    @classmethod
+    def build(cls, items):
+        """
+        Creates sketches of (user_id, user_data) items.
+        """
+        sketches = cls()
+        for user_id, user_data in items:
+            for date, entry in user_data.items():
+                sketches.add(user_id, date, entry)
+        return sketches
+
+    def update(self, user_id, date, entry, count):
+        """
+        Adds (count=1) or removes (count=-1) entry of user.
+        """
+        weekdays = self.users.setdefault(user_id, {})
+        histograms = weekdays.get(date.weekday())
+        if histograms is None:
+            histograms = weekdays[date.weekday()] = {
+                metric: Histogram() for metric in METRICS
+            }
+        for metric, value in zip(METRICS, entry_values(entry)):
+            histograms[metric].add(value, count)
+
+    def add(self, user_id, date, entry):
+        """
+        Adds entry of user.
+        """
+        self.update(user_id, date, entry, 1)
+
+    def remove(self, user_id, date, entry):
+        """
+        Removes entry of user added before.
+        """
+        self.update(user_id, date, entry, -1)
+
+    def updated(self, changes):
+        """
+        Returns sketches with given (user_id, date, old, new) changes applied.
+
+        Histograms of changed users are copied, so self stays untouched.
+        """
+        users = dict(self.users)
+        sketches = PresenceSketches(users)
+        copied = set()
+        for user_id, date, old, new in changes:
+            if user_id not in copied:
+                users[user_id] = {
+                    weekday: {
+                        metric: histogram.copy()
+                        for metric, histogram in histograms.items()
+                    }
+                    for weekday, histograms in self.users.get(
+                        user_id, {}).items()
+                }
+                copied.add(user_id)
+            if old is not None:
+                sketches.remove(user_id, date, old)
+            sketches.add(user_id, date, new)
+        return sketches
+
+    def quantiles(self, user_id, fractions=(0.1, 0.5, 0.9)):
+        """
+        Returns {weekday: {metric: [quantiles]}} of user's entries.
+        """
+        return {
+            weekday: {
+                metric: [histogram.quantile(fraction)
+                         for fraction in fractions]
+                for metric, histogram in histograms.items()
+            }
+            for weekday, histograms in self.users.get(user_id, {}).items()
+            if histograms['start'].total
+        }
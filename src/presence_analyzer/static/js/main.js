@@ -33,5 +33,31 @@ function parseInterval(value) {
                 user_avatar.show();
             }
         });
+
+        // refetch charts only when server announces new data
+        if(window.EventSource) {
+            var events = new EventSource(urls.api_events);
+            events.addEventListener('changed', function(event) {
+                var changed = JSON.parse(event.data),
+                    selected_user = dropdown.val();
+
+                if(changed.users_changed) {
+                    $.getJSON(urls.api_users, function(result) {
+                        $('option[value!=""]', dropdown).remove();
+                        $.each(result, function(item) {
+                            dropdown.append(
+                                $("<option />").data('avatar', this.avatar).
+                                    val(this.user_id).text(this.name)
+                            );
+                        });
+                        dropdown.val(selected_user);
+                    });
+                }
+                if(selected_user && (changed.users === null ||
+                        $.inArray(parseInt(selected_user, 10), changed.users) !== -1)) {
+                    dropdown.change();
+                }
+            });
+        }
     });
 })(jQuery);
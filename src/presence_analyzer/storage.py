@@ -0,0 +1,1239 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data storage backends.
+"""
+
+import os
+import re
+import csv
+import json
+import sqlite3
+import zlib
+from array import array
+from glob import glob, has_magic
+from itertools import izip
+from datetime import datetime, date as date_type, time as time_type
+from multiprocessing import Pool, cpu_count
+from threading import Lock
+
+from presence_analyzer.helpers import LRUCache, VersionedDict
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+# ordinal of the first day of Arrow's date32 type
+EPOCH_ORDINAL = date_type(1970, 1, 1).toordinal()
+
+# columns of Parquet and Arrow IPC presence files
+ARROW_COLUMNS = ('user_id', 'date', 'start', 'end')
+
+# lazily loaded users of IndexedCSVStorage, by (path, version, user_id)
+USER_CACHE = LRUCache(256)
+
+# offset indexes of IndexedCSVStorage, by path, and locks of their rebuilds
+INDEXES = {}
+INDEX_LOCKS = {}
+INDEX_LOCKS_LOCK = Lock()
+
+# data last loaded by CSVStorage, MultiCSVStorage and ArrowStorage, by path
+# or pattern
+LOADED = {}
+
+# storage backends made by get_storage_backend(), by their settings
+STORAGES = {}
+
+# config values storage backends are made from
+STORAGE_SETTINGS = ('STORAGE', 'DATA_CSV', 'DATA_DB', 'DATA_CSV_WORKERS',
+                    'DATA_QUARANTINE')
+
+# pools of processes parsing CSV chunks, by number of workers
+POOLS = {}
+POOLS_LOCK = Lock()
+
+# well-formed row: user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS
+ROW_PATTERN = re.compile(
+    r'(\d+),(\d{4})-(\d\d?)-(\d\d?),'
+    r'(\d\d?):(\d\d?):(\d\d?),(\d\d?):(\d\d?):(\d\d?)\s*$'
+)
+
+# reasons of rejecting rows
+REJECTIONS = ('malformed', 'out_of_range', 'end_before_start',
+              'duplicate_date')
+
+
+def clear_caches():
+    """
+    Forgets previously loaded data, indexes and users of all backends,
+    and the backends themselves.
+    """
+    LOADED.clear()
+    INDEXES.clear()
+    USER_CACHE.clear()
+    STORAGES.clear()
+
+
+class Intervals(object):
+    """
+    Presence intervals of one day: count (start, end) pairs of seconds
+    since midnight in flat arrays of IntervalStore, beginning at offset.
+    """
+
+    __slots__ = ('starts', 'ends', 'offset', 'count')
+
+    def __init__(self, starts, ends, offset, count):
+        self.starts = starts
+        self.ends = ends
+        self.offset = offset
+        self.count = count
+
+    def __iter__(self):
+        for i in xrange(self.offset, self.offset + self.count):
+            yield self.starts[i], self.ends[i]
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        return isinstance(other, Intervals) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Intervals(%r)' % list(self)
+
+    def union(self):
+        """
+        Returns sorted intervals with overlapping ones joined.
+        """
+        result = []
+        for start, end in sorted(self):
+            if result and start <= result[-1][1]:
+                result[-1][1] = max(result[-1][1], end)
+            else:
+                result.append([start, end])
+        return [(start, end) for start, end in result]
+
+    def duration(self):
+        """
+        Returns seconds covered by the intervals, overlaps counted once.
+        """
+        return sum(end - start for start, end in self.union())
+
+
+class IntervalStore(object):
+    """
+    Intervals of days with more than one presence interval, in CSR style:
+    flat arrays of starts and ends, each day refers to its range of them.
+
+    Days with single interval keep just 'start' and 'end' in their entry.
+    Ranges are only ever appended, so entries sharing the store are never
+    changed.
+    """
+
+    def __init__(self):
+        self.starts = array('l')
+        self.ends = array('l')
+        self.lock = Lock()
+
+    def __getstate__(self):
+        return self.starts, self.ends
+
+    def __setstate__(self, state):
+        self.starts, self.ends = state
+        self.lock = Lock()
+
+    def add(self, entry, start, end):
+        """
+        Returns new entry of a day with interval from start to end
+        (seconds since midnight) added to those of given entry, or None
+        when it already has exactly that interval.
+
+        Entry 'start' and 'end' become the earliest start and latest end.
+        """
+        intervals = entry.get('intervals')
+        current = entry_intervals(entry)
+        if (start, end) in current:
+            return None
+
+        with self.lock:
+            if intervals is not None and intervals.starts is self.starts \
+                    and intervals.offset + intervals.count == len(self.starts):
+                # range is the last one, so it can grow in place
+                offset = intervals.offset
+            else:
+                offset = len(self.starts)
+                for current_start, current_end in current:
+                    self.starts.append(current_start)
+                    self.ends.append(current_end)
+            self.starts.append(start)
+            self.ends.append(end)
+
+        return {
+            'start': min(entry['start'], seconds_to_time(start)),
+            'end': max(entry['end'], seconds_to_time(end)),
+            'intervals': Intervals(self.starts, self.ends, offset,
+                                   len(current) + 1),
+        }
+
+
+class PresenceData(VersionedDict):
+    """
+    Presence data grouped by user_id, tagged with version of its source.
+
+    Data updated incrementally has base_version of data it was built on
+    and list of changes: (user_id, date, old entry or None, new entry).
+    Entries of days with several intervals have them in 'intervals', kept
+    in IntervalStore of the data.
+    """
+
+    def __init__(self, data=(), version=None, base_version=None,
+                 changes=None):
+        super(PresenceData, self).__init__(data, version)
+        self.base_version = base_version
+        self.changes = changes
+        self.intervals = IntervalStore()
+        # rows rejected by validation: (line, reason, text)
+        self.rejected = []
+        # bytes and lines of CSV file the data was parsed from
+        self.offset = None
+        self.lines = None
+        self.checksum = None
+
+    def rejections(self):
+        """
+        Returns numbers of rejected rows by reason.
+        """
+        counts = dict.fromkeys(REJECTIONS, 0)
+        for _, reason, _ in self.rejected:
+            counts[reason] += 1
+        return counts
+
+    def rows(self):
+        """
+        Returns number of accepted rows.
+        """
+        return sum(
+            len(entry['intervals']) if 'intervals' in entry else 1
+            for user_data in self.values() for entry in user_data.values()
+        )
+
+
+def file_version(path):
+    """
+    Returns version of file which changes whenever file is modified.
+    """
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    return time_type(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def time_to_seconds(value):
+    """
+    Converts datetime.time to amount of seconds since midnight.
+    """
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def parse_time(value):
+    """
+    Parses HH:MM:SS into amount of seconds since midnight.
+    """
+    value = datetime.strptime(value, '%H:%M:%S')
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def filter_dates(user_data, start=None, end=None):
+    """
+    Returns entries of user_data between start and end dates (inclusive).
+    """
+    if start is None and end is None:
+        return user_data
+    return {
+        date: row for date, row in user_data.items()
+        if (start is None or date >= start) and (end is None or date <= end)
+    }
+
+
+def load_csv(path, workers=0):
+    """
+    Parses presence CSV file, in parallel if workers > 1.
+    """
+    return merge_chunks(parse_csv(path, workers))
+
+
+def parse_csv(path, workers=0, size=None):
+    """
+    Parses first size bytes (whole file by default) of presence CSV file
+    into chunks, in parallel if workers > 1.
+    """
+    if size is None:
+        size = os.path.getsize(path)
+
+    pool = get_pool(workers)
+    if pool is not None:
+        return pool.map(parse_chunk, [
+            (path, start, end)
+            for start, end in chunk_offsets(path, workers * 2, size)
+        ])
+
+    return [parse_chunk((path, 0, size))]
+
+
+def get_pool(workers):
+    """
+    Returns pool of given number of processes parsing CSV chunks, None
+    when chunks should be parsed in current process.
+
+    Workers are limited to number of CPUs, so there is no pool on single
+    CPU. Pool is created once per process; make_app() creates it before
+    server threads start, so they are not forked with it.
+    """
+    workers = min(workers, cpu_count())
+    if workers < 2:
+        return None
+    with POOLS_LOCK:
+        pool = POOLS.get(workers)
+        if pool is None:
+            pool = POOLS[workers] = Pool(workers)
+    return pool
+
+
+def chunk_offsets(path, count, size=None):
+    """
+    Splits file (or its first size bytes) into at most count byte ranges
+    aligned to line boundaries.
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as csvfile:
+        for i in range(1, count):
+            csvfile.seek(size * i // count)
+            csvfile.readline()
+            offset = min(csvfile.tell(), size)
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return zip(offsets, offsets[1:])
+
+
+def parse_chunk(args):
+    """
+    Parses and validates rows of CSV file from given byte range into
+    compact arrays.
+
+    Takes (path, start, end) tuple, end of None means end of file.
+    Returns dict with 'user_id', 'date' (ordinal), 'start', 'end' (seconds
+    since midnight) and 'line' arrays of accepted rows, list of rejected
+    (line, reason, text) tuples and number of lines read.
+
+    Well-formed rows are matched by ROW_PATTERN and checked with integer
+    comparisons only. Other lines go through csv module and strptime; lines
+    not of 4 fields and unparsable first line of file (header) are ignored.
+    """
+    path, start_offset, end_offset = args
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start_offset)
+        if end_offset is None:
+            content = csvfile.read()
+        else:
+            content = csvfile.read(end_offset - start_offset)
+
+    chunk = {
+        'user_id': array('l'),
+        'date': array('l'),
+        'start': array('l'),
+        'end': array('l'),
+        'line': array('l'),
+        'rejected': [],
+        'lines': 0,
+    }
+    match = ROW_PATTERN.match
+    lines = content.splitlines()
+    for i, text in enumerate(lines):
+        fields = match(text)
+        if fields is not None:
+            (user_id, year, month, day,
+             start_h, start_m, start_s, end_h, end_m, end_s) = [
+                int(field) for field in fields.groups()]
+            if start_h > 23 or start_m > 59 or start_s > 59 or \
+                    end_h > 23 or end_m > 59 or end_s > 59:
+                chunk['rejected'].append((i, 'out_of_range', text))
+                continue
+            try:
+                date = date_type(year, month, day).toordinal()
+            except ValueError:
+                chunk['rejected'].append((i, 'out_of_range', text))
+                continue
+            start = start_h * 3600 + start_m * 60 + start_s
+            end = end_h * 3600 + end_m * 60 + end_s
+        else:
+            row = next(csv.reader([text], delimiter=','), [])
+            if len(row) != 4:
+                # ignore header and footer lines
+                continue
+            try:
+                user_id = int(row[0])
+                date = datetime.strptime(row[1], '%Y-%m-%d').toordinal()
+                start = parse_time(row[2])
+                end = parse_time(row[3])
+            except (ValueError, TypeError):
+                if i or start_offset:
+                    chunk['rejected'].append((i, 'malformed', text))
+                # else it is header line
+                continue
+
+        if end < start:
+            chunk['rejected'].append((i, 'end_before_start', text))
+            continue
+
+        chunk['user_id'].append(user_id)
+        chunk['date'].append(date)
+        chunk['start'].append(start)
+        chunk['end'].append(end)
+        chunk['line'].append(i)
+
+    chunk['lines'] = len(lines)
+    return chunk
+
+
+def log_chunk_errors(chunk, line):
+    """
+    Logs rows rejected in chunk starting at given line.
+    Returns line following the chunk.
+    """
+    for i, reason, _ in chunk['rejected']:
+        log.debug('Problem with line %d: %s', line + i, reason)
+    return line + chunk['lines']
+
+
+def entry_intervals(entry):
+    """
+    Returns (start, end) intervals of day entry in seconds since midnight.
+    """
+    if 'intervals' in entry:
+        return list(entry['intervals'])
+    return [(time_to_seconds(entry['start']), time_to_seconds(entry['end']))]
+
+
+def add_interval(user_data, intervals, day, start, end):
+    """
+    Adds interval from start to end (seconds since midnight) to entry of
+    day in user_data; further intervals of the day are kept in given
+    IntervalStore. Returns False when the day already has that interval.
+    """
+    entry = user_data.get(day)
+    if entry is None:
+        user_data[day] = {'start': seconds_to_time(start),
+                          'end': seconds_to_time(end)}
+        return True
+    entry = intervals.add(entry, start, end)
+    if entry is None:
+        return False
+    user_data[day] = entry
+    return True
+
+
+def format_row(user_id, date, start, end):
+    """
+    Formats parsed row back as CSV line.
+    """
+    return '%d,%s,%s,%s' % (user_id, date_type.fromordinal(date),
+                            seconds_to_time(start), seconds_to_time(end))
+
+
+def merge_chunks(chunks, version=None, line=0):
+    """
+    Groups rows of parsed chunks by user_id.
+
+    Further rows of a date already present for the user add intervals to
+    it, repeated intervals are rejected as 'duplicate_date'. Rejected rows
+    of chunks are
+    collected in 'rejected' of returned PresenceData, with line numbers
+    counted from given line of the first chunk.
+    """
+    data = PresenceData(version=version)
+    rejected = data.rejected
+    times = {}
+    days = {}
+    for chunk in chunks:
+        rejected.extend((line + i, reason, text)
+                        for i, reason, text in chunk['rejected'])
+        for user_id, date, start, end, i in izip(chunk['user_id'],
+                                                 chunk['date'],
+                                                 chunk['start'],
+                                                 chunk['end'],
+                                                 chunk['line']):
+            user_data = data.get(user_id)
+            if user_data is None:
+                user_data = data[user_id] = {}
+            day = days.get(date)
+            if day is None:
+                day = days[date] = date_type.fromordinal(date)
+            if day in user_data:
+                entry = data.intervals.add(user_data[day], start, end)
+                if entry is None:
+                    rejected.append((line + i, 'duplicate_date',
+                                     format_row(user_id, date, start, end)))
+                else:
+                    user_data[day] = entry
+                continue
+
+            if start not in times:
+                times[start] = seconds_to_time(start)
+            if end not in times:
+                times[end] = seconds_to_time(end)
+            user_data[day] = {'start': times[start], 'end': times[end]}
+        line += chunk['lines']
+
+    rejected.sort()
+    for i, reason, _ in rejected:
+        log.debug('Problem with line %d: %s', i, reason)
+    return data
+
+
+class Storage(object):
+    """
+    Base class of presence data backends.
+    """
+
+    # True when backend reads rows of single user without loading others
+    indexed = False
+
+    def version(self):
+        """
+        Returns version of stored data, changes when data is modified.
+        """
+        raise NotImplementedError
+
+    def load(self):
+        """
+        Returns PresenceData of all users.
+        """
+        raise NotImplementedError
+
+    def user_ids(self):
+        """
+        Returns ids of users with any presence entries.
+        """
+        return self.load().keys()
+
+    def user_data(self, user_id, start=None, end=None):
+        """
+        Returns presence entries of given user between given dates.
+        """
+        return filter_dates(self.load().get(user_id, {}), start, end)
+
+
+def tail_checksum(path, offset, size=4096):
+    """
+    Returns checksum of size bytes of file preceding offset.
+    """
+    with open(path, 'rb') as data_file:
+        data_file.seek(max(0, offset - size))
+        return zlib.crc32(data_file.read(min(offset, size)))
+
+
+class CSVStorage(Storage):
+    """
+    Presence data in flat CSV file, always loaded as a whole.
+
+    When the file only had rows appended since previous load, just the
+    appended part is parsed and applied to previously loaded data.
+    """
+
+    def __init__(self, path, workers=0, quarantine=None):
+        self.path = path
+        self.workers = workers
+        self.quarantine = quarantine
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage from app config.
+        """
+        return cls(config['DATA_CSV'], config.get('DATA_CSV_WORKERS', 0),
+                   config.get('DATA_QUARANTINE'))
+
+    def version(self):
+        return file_version(self.path)
+
+    def load(self):
+        version = self.version()
+        previous = LOADED.get(self.path)
+        if previous is not None and previous.version == version:
+            return previous
+
+        appended = previous is not None and \
+            self.appended(previous, version[1])
+        if appended:
+            data = self.load_appended(previous, version)
+        else:
+            data = self.parsed(
+                parse_csv(self.path, self.workers, version[1]), version)
+        return self.loaded(data, previous if appended else None)
+
+    def parsed(self, chunks, version):
+        """
+        Returns PresenceData of whole file built from its parsed chunks.
+        """
+        data = merge_chunks(chunks, version)
+        data.lines = sum(chunk['lines'] for chunk in chunks)
+        return data
+
+    def loaded(self, data, previous=None):
+        """
+        Records data of version loaded from file, writes rejected rows to
+        quarantine. Previous is data the new one was appended to.
+        """
+        appended = previous is not None
+        data.offset = data.version[1]
+        data.checksum = tail_checksum(self.path, data.offset)
+        if self.quarantine:
+            rejected = data.rejected
+            if appended:
+                rejected = rejected[len(previous.rejected):]
+            write_quarantine(self.quarantine, rejected, appended)
+        log.info('Loaded %d rows of %s, rejected: %s', data.rows(),
+                 self.path, ', '.join(
+                     '%s %d' % (reason, count) for reason, count
+                     in sorted(data.rejections().items()) if count
+                 ) or 'none')
+        LOADED[self.path] = data
+        return data
+
+    def appended(self, previous, size):
+        """
+        Tells whether file only had lines appended since previous load.
+        """
+        if not 0 < previous.offset < size:
+            return False
+        with open(self.path, 'rb') as csvfile:
+            csvfile.seek(previous.offset - 1)
+            if csvfile.read(1) not in ('\n', '\r'):
+                return False
+        return tail_checksum(self.path, previous.offset) == previous.checksum
+
+    def load_appended(self, previous, version):
+        """
+        Parses lines appended after previous load and applies them to
+        copy of previous data.
+
+        Only dicts of users with new entries are copied, intervals are
+        added to store shared with previous data. Rejected rows of the
+        appended part are added to previous ones.
+        """
+        chunk = parse_chunk((self.path, previous.offset, version[1]))
+
+        data = PresenceData(previous, version, previous.version, [])
+        data.intervals = previous.intervals
+        data.lines = previous.lines + chunk['lines']
+        data.rejected = previous.rejected + [
+            (previous.lines + i, reason, text)
+            for i, reason, text in chunk['rejected']
+        ]
+        copied = set()
+        for user_id, date, start, end, i in izip(chunk['user_id'],
+                                                 chunk['date'],
+                                                 chunk['start'],
+                                                 chunk['end'],
+                                                 chunk['line']):
+            if user_id not in copied:
+                data[user_id] = dict(previous.get(user_id, {}))
+                copied.add(user_id)
+
+            day = date_type.fromordinal(date)
+            old = data[user_id].get(day)
+            if old is None:
+                entry = {'start': seconds_to_time(start),
+                         'end': seconds_to_time(end)}
+            else:
+                entry = data.intervals.add(old, start, end)
+            if entry is None:
+                data.rejected.append((previous.lines + i, 'duplicate_date',
+                                      format_row(user_id, date, start, end)))
+                continue
+
+            data.changes.append((user_id, day, old, entry))
+            data[user_id][day] = entry
+
+        for i, reason, _ in data.rejected[len(previous.rejected):]:
+            log.debug('Problem with line %d: %s', i, reason)
+        return data
+
+
+def write_quarantine(path, rejected, append=False):
+    """
+    Writes rejected rows to quarantine CSV file: line, reason and the row.
+    """
+    with open(path, 'ab' if append else 'wb') as quarantine:
+        writer = csv.writer(quarantine)
+        for row in rejected:
+            writer.writerow(row)
+
+
+class MultiCSVStorage(Storage):
+    """
+    Presence data in CSV files matching glob pattern or in directory.
+
+    Each file is loaded by CSVStorage and kept by its version, so only new
+    and modified files are parsed, in parallel if workers > 1. Intervals of
+    the same user_id and date in several files are joined in sorted order
+    of files, repeated ones are rejected.
+    """
+
+    def __init__(self, pattern, workers=0, quarantine=None):
+        self.pattern = pattern
+        self.workers = workers
+        self.quarantine = quarantine
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage from app config.
+        """
+        return cls(config['DATA_CSV'], config.get('DATA_CSV_WORKERS', 0),
+                   config.get('DATA_QUARANTINE'))
+
+    def paths(self):
+        """
+        Returns sorted paths of files matching the pattern.
+        """
+        pattern = self.pattern
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.csv')
+        return sorted(glob(pattern))
+
+    def version(self):
+        return tuple((path, file_version(path)) for path in self.paths())
+
+    def load(self):
+        version = self.version()
+        previous = LOADED.get(self.pattern)
+        if previous is not None and previous.version == version:
+            return previous
+
+        if previous is not None:
+            # forget files which no longer match the pattern
+            paths = set(path for path, _ in version)
+            for path, _ in previous.version:
+                if path not in paths:
+                    LOADED.pop(path, None)
+
+        files = [CSVStorage(path) for path, _ in version]
+        stale = [
+            (csv_storage, path_version)
+            for csv_storage, (path, path_version) in zip(files, version)
+            if path not in LOADED or
+            LOADED[path].version != path_version and
+            not csv_storage.appended(LOADED[path], path_version[1])
+        ]
+        pool = get_pool(self.workers)
+        if pool is not None and len(stale) > 1:
+            chunks = pool.map(parse_chunk, [
+                (csv_storage.path, 0, path_version[1])
+                for csv_storage, path_version in stale
+            ])
+            for (csv_storage, path_version), chunk in zip(stale, chunks):
+                csv_storage.loaded(csv_storage.parsed([chunk], path_version))
+
+        data = self.merge([
+            (csv_storage.path, csv_storage.load()) for csv_storage in files
+        ])
+        LOADED[self.pattern] = data
+        return data
+
+    def merge(self, loaded):
+        """
+        Merges PresenceData of (path, data) pairs in their order.
+
+        Rejected rows are written to quarantine with path of their file.
+        """
+        data = PresenceData(version=tuple(
+            (path, file_data.version) for path, file_data in loaded))
+        quarantine = []
+        for path, file_data in loaded:
+            rejected = list(file_data.rejected)
+            for user_id, entries in file_data.items():
+                user_data = data.get(user_id)
+                if user_data is None:
+                    data[user_id] = dict(entries)
+                    continue
+                for date, entry in entries.items():
+                    if date not in user_data:
+                        user_data[date] = entry
+                        continue
+                    for start, end in entry_intervals(entry):
+                        merged = data.intervals.add(user_data[date],
+                                                    start, end)
+                        if merged is None:
+                            rejected.append((None, 'duplicate_date',
+                                             format_row(user_id,
+                                                        date.toordinal(),
+                                                        start, end)))
+                        else:
+                            user_data[date] = merged
+            data.rejected.extend(rejected)
+            quarantine.extend((path,) + row for row in rejected)
+
+        if self.quarantine:
+            write_quarantine(self.quarantine, quarantine)
+        log.info('Merged %d rows of %d files', data.rows(), len(loaded))
+        return data
+
+
+def index_path(path):
+    """
+    Returns path of offset index of given CSV file.
+    """
+    return path + '.idx'
+
+
+def build_index(path):
+    """
+    Maps user_ids to byte ranges of their rows in CSV file.
+
+    Consecutive rows of a user share one range. Lines not starting with
+    an integer user_id (header, footer) are left out.
+    Returns dict with 'version' of indexed file and 'users' ranges.
+    """
+    version = file_version(path)
+    users = {}
+    offset = 0
+    with open(path, 'rb') as csvfile:
+        for line in csvfile:
+            end = offset + len(line)
+            try:
+                user_id = int(line.split(',', 1)[0])
+            except ValueError:
+                user_id = None
+
+            if user_id is not None:
+                ranges = users.setdefault(user_id, [])
+                if ranges and ranges[-1][1] == offset:
+                    ranges[-1][1] = end
+                else:
+                    ranges.append([offset, end])
+            offset = end
+
+    return {'version': version, 'users': users}
+
+
+def write_index(path, index):
+    """
+    Saves offset index next to CSV file.
+
+    Index is written to temporary file renamed over the old one, so
+    readers never see partially written index.
+    """
+    tmp_path = '%s.%d.tmp' % (index_path(path), os.getpid())
+    with open(tmp_path, 'w') as index_file:
+        json.dump(index, index_file)
+    os.rename(tmp_path, index_path(path))
+
+
+def read_index(path):
+    """
+    Reads offset index of CSV file, returns None if there is none.
+    """
+    try:
+        with open(index_path(path)) as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError):
+        return None
+
+    return {
+        'version': tuple(index['version']),
+        'users': {int(k): v for k, v in index['users'].items()},
+    }
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which is needed for Parquet and Arrow IPC files only.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet  # pylint: disable=W0612
+    except ImportError:
+        raise RuntimeError('pyarrow is required for Parquet and Arrow files')
+    return pyarrow
+
+
+def is_parquet(path):
+    """
+    Tells whether path names Parquet (rather than Arrow IPC) file.
+    """
+    return path.endswith('.parquet')
+
+
+def export_arrow(csv_path, path, chunk_size=16*1024*1024):
+    """
+    Converts presence CSV file into Parquet or Arrow IPC file.
+
+    Format is chosen by path extension. Each CSV chunk becomes a row group
+    or record batch, so only one chunk is kept in memory.
+    Returns number of exported rows.
+    """
+    pyarrow = import_pyarrow()
+    schema = pyarrow.schema([
+        ('user_id', pyarrow.int64()),
+        ('date', pyarrow.date32()),
+        ('start', pyarrow.time32('s')),
+        ('end', pyarrow.time32('s')),
+    ])
+    if is_parquet(path):
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pyarrow.RecordBatchFileWriter(path, schema)
+
+    exported = 0
+    line = 0
+    count = max(1, os.path.getsize(csv_path) // chunk_size)
+    try:
+        for start, end in chunk_offsets(csv_path, count):
+            chunk = parse_chunk((csv_path, start, end))
+            line = log_chunk_errors(chunk, line)
+            days = [day - EPOCH_ORDINAL for day in chunk['date']]
+            table = pyarrow.Table.from_arrays([
+                pyarrow.array(chunk['user_id'], type=pyarrow.int64()),
+                pyarrow.array(days, type=pyarrow.date32()),
+                pyarrow.array(chunk['start'], type=pyarrow.time32('s')),
+                pyarrow.array(chunk['end'], type=pyarrow.time32('s')),
+            ], schema=schema)
+            writer.write_table(table)
+            exported += len(chunk['user_id'])
+    finally:
+        writer.close()
+    return exported
+
+
+class IndexedCSVStorage(CSVStorage):
+    """
+    Presence data in flat CSV file, read user by user using offset index.
+
+    Index is built with bin/flask-ctl index_csv; when it is missing or
+    does not match the file, it is rebuilt on first use. Parsed users are
+    kept in USER_CACHE, sized by make_app() from DATA_CSV_CACHE_USERS.
+    """
+
+    indexed = True
+
+    def index(self):
+        """
+        Returns offset index matching current version of the file.
+
+        Only one thread reads or rebuilds index of the file at once, the
+        others wait for its result.
+        """
+        version = self.version()
+        index = INDEXES.get(self.path)
+        if index is not None and index['version'] == version:
+            return index
+
+        with INDEX_LOCKS_LOCK:
+            lock = INDEX_LOCKS.setdefault(self.path, Lock())
+        with lock:
+            index = INDEXES.get(self.path)
+            if index is None or index['version'] != version:
+                index = read_index(self.path)
+            if index is None or index['version'] != version:
+                log.info('Building offset index of %s', self.path)
+                index = build_index(self.path)
+                try:
+                    write_index(self.path, index)
+                except (IOError, OSError):
+                    log.warning('Cannot save offset index of %s', self.path,
+                                exc_info=True)
+            INDEXES[self.path] = index
+        return index
+
+    def user_ids(self):
+        return self.index()['users'].keys()
+
+    def user_data(self, user_id, start=None, end=None):
+        index = self.index()
+        key = (self.path, index['version'], user_id)
+        user_data = USER_CACHE.get(key)
+        if user_data is None:
+            chunks = [parse_chunk((self.path, range_start, range_end))
+                      for range_start, range_end
+                      in index['users'].get(user_id, [])]
+            user_data = merge_chunks(chunks).get(user_id, {})
+            USER_CACHE.set(key, user_data)
+        return filter_dates(user_data, start, end)
+
+
+class ArrowStorage(Storage):
+    """
+    Presence data in Parquet or Arrow IPC file.
+
+    Both are read through memory map and converted to PresenceData, which
+    is kept in LOADED until the file changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage from app config.
+        """
+        return cls(config['DATA_CSV'])
+
+    def version(self):
+        return file_version(self.path)
+
+    def read_table(self):
+        """
+        Returns pyarrow.Table with contents of the file.
+        """
+        pyarrow = import_pyarrow()
+        if is_parquet(self.path):
+            return pyarrow.parquet.read_table(
+                self.path, columns=list(ARROW_COLUMNS), memory_map=True)
+        return pyarrow.ipc.open_file(pyarrow.memory_map(self.path)).read_all()
+
+    def load(self):
+        version = self.version()
+        previous = LOADED.get(self.path)
+        if previous is not None and previous.version == version:
+            return previous
+
+        table = self.read_table()
+        columns = [table.column(name).to_pylist() for name in ARROW_COLUMNS]
+
+        data = PresenceData(version=version)
+        for user_id, date, start, end in izip(*columns):
+            user_data = data.get(user_id)
+            if user_data is None:
+                user_data = data[user_id] = {}
+            add_interval(user_data, data.intervals, date,
+                         time_to_seconds(start), time_to_seconds(end))
+        LOADED[self.path] = data
+        return data
+
+
+class SQLiteStorage(Storage):
+    """
+    Presence data in SQLite database indexed by (user_id, date).
+
+    Each row is one presence interval, a day may have several of them.
+    """
+
+    indexed = True
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS presence (
+            user_id INTEGER NOT NULL,
+            date INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS presence_user_date
+            ON presence (user_id, date)
+        """,
+    )
+
+    # user_version of database with SCHEMA; older ones keep one row per
+    # (user_id, date) as primary key
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates storage from app config.
+        """
+        return cls(config['DATA_DB'])
+
+    def connect(self):
+        """
+        Returns new connection to the database, creating or migrating
+        schema if needed.
+        """
+        connection = sqlite3.connect(self.path)
+        version, = connection.execute('PRAGMA user_version').fetchone()
+        if version != self.SCHEMA_VERSION:
+            self.migrate(connection)
+        return connection
+
+    def migrate(self, connection):
+        """
+        Creates schema, moving rows of table of older schema into it.
+
+        Runs in one explicit transaction, as Python's sqlite3 commits
+        before DDL statements otherwise.
+        """
+        connection.isolation_level = None
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                version, = connection.execute(
+                    'PRAGMA user_version').fetchone()
+                if version != self.SCHEMA_VERSION:
+                    table = connection.execute(
+                        "SELECT sql FROM sqlite_master WHERE type = 'table' "
+                        "AND name = 'presence'").fetchone()
+                    old = table is not None and 'PRIMARY KEY' in table[0]
+                    if old:
+                        connection.execute(
+                            'ALTER TABLE presence RENAME TO presence_old')
+                    for statement in self.SCHEMA:
+                        connection.execute(statement)
+                    if old:
+                        log.info('Migrating schema of %s', self.path)
+                        connection.execute(
+                            'INSERT INTO presence SELECT user_id, date, '
+                            'start, end FROM presence_old')
+                        connection.execute('DROP TABLE presence_old')
+                    connection.execute(
+                        'PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.isolation_level = ''
+
+    def version(self):
+        if not os.path.exists(self.path):
+            # database is created on first connect()
+            return None
+        return file_version(self.path)
+
+    def load(self):
+        version = self.version()
+        data = PresenceData(version=version)
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                'SELECT user_id, date, start, end FROM presence')
+            for user_id, date, start, end in rows:
+                user_data = data.get(user_id)
+                if user_data is None:
+                    user_data = data[user_id] = {}
+                add_interval(user_data, data.intervals,
+                             date_type.fromordinal(date), start, end)
+        finally:
+            connection.close()
+        return data
+
+    def user_ids(self):
+        connection = self.connect()
+        try:
+            return [user_id for user_id, in connection.execute(
+                'SELECT DISTINCT user_id FROM presence')]
+        finally:
+            connection.close()
+
+    def user_data(self, user_id, start=None, end=None):
+        query = 'SELECT date, start, end FROM presence WHERE user_id = ?'
+        params = [user_id]
+        if start is not None:
+            query += ' AND date >= ?'
+            params.append(start.toordinal())
+        if end is not None:
+            query += ' AND date <= ?'
+            params.append(end.toordinal())
+
+        user_data = {}
+        intervals = IntervalStore()
+        connection = self.connect()
+        try:
+            for date, start_time, end_time in connection.execute(query,
+                                                                 params):
+                add_interval(user_data, intervals,
+                             date_type.fromordinal(date), start_time,
+                             end_time)
+        finally:
+            connection.close()
+        return user_data
+
+    def import_csv(self, path, chunk_size=16*1024*1024):
+        """
+        Replaces stored data with contents of CSV file.
+
+        File is parsed chunk by chunk, so only one chunk is kept in memory.
+        Rows of the same user_id and date are kept as intervals of the day,
+        repeated intervals are skipped. Data is replaced in one transaction,
+        so readers see the old data until the import is done, and keep it
+        when the import fails.
+        Returns number of imported rows.
+        """
+        count = max(1, os.path.getsize(path) // chunk_size)
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM presence')
+                changes = connection.total_changes
+                line = 0
+                for start, end in chunk_offsets(path, count):
+                    chunk = parse_chunk((path, start, end))
+                    line = log_chunk_errors(chunk, line)
+
+                    connection.executemany(
+                        'INSERT INTO presence SELECT ?, ?, ?, ? WHERE NOT '
+                        'EXISTS (SELECT 1 FROM presence WHERE user_id = ? '
+                        'AND date = ? AND start = ? AND end = ?)',
+                        (row * 2 for row in izip(
+                            chunk['user_id'], chunk['date'],
+                            chunk['start'], chunk['end'])))
+                imported = connection.total_changes - changes
+        finally:
+            connection.close()
+        return imported
+
+
+# storage backends by STORAGE config value
+BACKENDS = {
+    'csv': CSVStorage,
+    'indexed_csv': IndexedCSVStorage,
+    'sqlite': SQLiteStorage,
+}
+
+# backends of DATA_CSV files other than CSV, by extension
+FILE_FORMATS = {
+    '.parquet': ArrowStorage,
+    '.arrow': ArrowStorage,
+}
+
+
+def make_storage(config):
+    """
+    Creates storage backend configured in app config.
+    """
+    backend = BACKENDS[config.get('STORAGE', 'csv')]
+    if backend is CSVStorage:
+        path = config['DATA_CSV']
+        if has_magic(path) or os.path.isdir(path):
+            backend = MultiCSVStorage
+        else:
+            backend = FILE_FORMATS.get(os.path.splitext(path)[1], backend)
+    return backend.from_config(config)
+
+
+def get_storage_backend(config):
+    """
+    Returns storage backend configured in app config, made by
+    make_storage() once per STORAGE_SETTINGS values.
+    """
+    settings = tuple(config.get(name) for name in STORAGE_SETTINGS)
+    backend = STORAGES.get(settings)
+    if backend is None:
+        backend = STORAGES.setdefault(settings, make_storage(config))
+    return backend
@@ -3,13 +3,28 @@
 Presence analyzer unit tests.
 """
 import os.path
+import csv
 import json
 import datetime
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
+import zipfile
+from io import BytesIO
 from mock import patch
 from random import randint
 
-from presence_analyzer import main, views, utils, decorators, helpers
+from presence_analyzer import main, views, utils, decorators, helpers, \
+    storage, sketches, admission, caches, anomalies
+
+msgpack = utils.import_msgpack()  # pylint: disable=C0103
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None  # pylint: disable=C0103
 
 CURRENT_PATH = os.path.dirname(__file__)
 TEST_DATA_CSV = os.path.join(
@@ -213,6 +228,197 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data, [])
 
+    def test_presence_quantiles_view(self):
+        """
+        Test quantiles of start, end and duration
+        """
+        resp = self.client.get('/api/v1/presence_quantiles/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data[0][:4], [u'Weekday', u'Start p10',
+                                       u'Start median', u'Start p90'])
+        self.assertEqual(len(data[0]), 10)
+        # single entry: 2013-09-10 09:39:05 - 17:59:52
+        self.assertEqual(data[1][0], u'Tue')
+        self.assertEqual(data[1][2], 9*3600 + 39*60 + 30)
+        self.assertEqual(data[1][5], 17*3600 + 59*60 + 30)
+
+        with patch.object(views.log, 'debug') as mock_logger:
+            resp = self.client.get('/api/v1/presence_quantiles/12')
+        mock_logger.assert_called_once_with('User %s not found!', 12)
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_presence_hours_view(self):
+        """
+        Test presence histogram by time of day
+        """
+        resp = self.client.get('/api/v1/presence_hours/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 97)
+        self.assertEqual(data[0], [u'Time', u'Mon', u'Tue', u'Wed', u'Thu',
+                                   u'Fri', u'Sat', u'Sun'])
+        # 2013-09-13 (Fri) 13:16:56 - 15:04:02
+        self.assertEqual(data[54][0], u'13:15')
+        self.assertEqual(data[54][5], 0.871)
+        self.assertEqual(data[55][5], 1)
+        self.assertEqual(data[61][5], 0.269)
+        self.assertEqual(data[62][5], 0)
+
+        resp = self.client.get('/api/v1/presence_hours')
+        data = json.loads(resp.data)
+        # users 10 and 11 on 2013-09-10 (Tue) at 10:00
+        self.assertEqual(data[41][2], 2)
+
+    @patch.object(views.log, 'debug')
+    def test_presence_hours_view_log(self, mock_logger):
+        """
+        Test presence histogram for non-existing user
+        """
+        resp = self.client.get('/api/v1/presence_hours/12')
+        mock_logger.assert_called_once_with('User %s not found!', 12)
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_response_formats(self):
+        """
+        Test negotiating response format with Accept header
+        """
+        url = '/api/v1/presence_weekday/10'
+        resp = self.client.get(url, headers={'Accept': 'text/html'})
+        self.assertEqual(resp.content_type, 'application/json')
+
+        resp = self.client.get(url, headers={'Accept': utils.NDJSON})
+        self.assertEqual(resp.content_type, utils.NDJSON)
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(json.loads(lines[2]), [u'Tue', 30047])
+
+        resp = self.client.get('/api/v1/users',
+                               headers={'Accept': utils.NDJSON})
+        self.assertEqual(len(resp.data.splitlines()), 9)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_format(self):
+        """
+        Test MessagePack responses
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'Accept': utils.MSGPACK})
+        self.assertEqual(resp.content_type, utils.MSGPACK)
+        self.assertEqual(msgpack.unpackb(resp.data)[2], ['Tue', 30047])
+
+    def test_bulk_view(self):
+        """
+        Test streaming payloads of many users
+        """
+        resp = self.client.get('/api/v1/bulk/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([row['user_id'] for row in data], [10, 11])
+        self.assertEqual(data[0]['data'][2], [u'Tue', 30047])
+
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_id=11'
+                               '&user_id=12', headers={'Accept': 'text/html'})
+        self.assertEqual([row['user_id'] for row in json.loads(resp.data)],
+                         [11])
+
+        resp = self.client.get('/api/v1/bulk/presence_weekday?user_id=12')
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get('/api/v1/bulk/mean_time_weekday',
+                               headers={'Accept': utils.NDJSON})
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(lines[0]['user_id'], 10)
+        self.assertEqual(lines[1]['data'][2], [u'Wed', 25321.0])
+
+        resp = self.client.get('/api/v1/bulk/nope')
+        self.assertEqual(resp.status_code, 404)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_bulk_view_msgpack(self):
+        """
+        Test streaming payloads of many users as MessagePack
+        """
+        resp = self.client.get('/api/v1/bulk/presence_start_end',
+                               headers={'Accept': utils.MSGPACK})
+        records = list(msgpack.Unpacker(BytesIO(resp.data)))
+        self.assertEqual([row['user_id'] for row in records], [10, 11])
+        self.assertEqual(len(records[1]['data']), 5)
+
+    def test_export_view(self):
+        """
+        Test exporting daily presence entries as CSV
+        """
+        resp = self.client.get('/api/v1/export.csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertIn('filename=presence.csv',
+                      resp.headers['Content-Disposition'])
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'user_id,date,start,end,duration')
+        self.assertEqual(lines[1], '10,2013-09-10,09:39:05,17:59:52,30047')
+        self.assertEqual(len(lines), 10)
+
+        resp = self.client.get('/api/v1/export.csv?user_id=11'
+                               '&start=2013-09-10&end=2013-09-12')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith('11,2013-09-10,'))
+        self.assertTrue(lines[3].startswith('11,2013-09-12,'))
+
+        resp = self.client.get('/api/v1/export.csv?start=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.get('/api/v1/export.pdf')
+        self.assertEqual(resp.status_code, 404)
+
+        with patch.object(views.export, 'xlsxwriter', None):
+            resp = self.client.get('/api/v1/export.xlsx')
+        self.assertEqual(resp.status_code, 501)
+        self.assertNotIn('Content-Disposition', resp.headers)
+
+    @unittest.skipIf(xlsxwriter is None, 'XlsxWriter is not installed')
+    def test_export_view_xlsx(self):
+        """
+        Test exporting daily presence entries as XLSX
+        """
+        resp = self.client.get('/api/v1/export.xlsx?user_id=10')
+        self.assertEqual(resp.status_code, 200)
+        workbook = zipfile.ZipFile(BytesIO(resp.data))
+        sheet = workbook.read('xl/worksheets/sheet1.xml')
+        self.assertIn('<v>30047</v>', sheet)
+
+    def test_events_view(self):
+        """
+        Test Server-Sent Events stream
+        """
+        main.app.config.update({'EVENTS_MAX_AGE': 0})
+        resp = self.client.get('/api/v1/events')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertIn('event: version\n', resp.data)
+        resp.close()
+
+        resp = self.client.get('/api/v1/events',
+                               headers={'Last-Event-ID': 'old'})
+        self.assertIn('event: changed\n', resp.data)
+        self.assertIn('"users": null', resp.data)
+        resp.close()
+        self.assertEqual(views.EVENT_STREAMS.taken, 0)
+
+        main.app.config.update({'EVENTS_MAX_STREAMS': 1})
+        stream = self.client.get('/api/v1/events', buffered=False)
+        self.assertEqual(stream.status_code, 200)
+        resp = self.client.get('/api/v1/events')
+        self.assertEqual(resp.status_code, 204)
+        stream.close()
+        resp = self.client.get('/api/v1/events')
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+        main.app.config.update({'EVENTS_MAX_STREAMS': 12})
+
     def test_template_view(self):
         """
         Test template_view view
@@ -229,6 +435,73 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
         self.assertIn(resp.content_type, VALID_HTML_MIME)
 
+    def test_ready_view(self):
+        """
+        Test readiness probe
+        """
+        resp = self.client.get('/api/v1/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), {'ready': True})
+
+        with patch.object(views.READY, 'is_set', return_value=False):
+            resp = self.client.get('/api/v1/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(json.loads(resp.data), {'ready': False})
+
+    def test_admin_reload_view(self):
+        """
+        Test reloading data with admin endpoint
+        """
+        resp = self.client.post('/api/v1/admin/reload')
+        self.assertEqual(resp.status_code, 404)
+
+        main.app.config.update({'ADMIN_TOKEN': 'secret'})
+        try:
+            resp = self.client.post('/api/v1/admin/reload', headers={
+                'Authorization': 'Bearer wrong'})
+            self.assertEqual(resp.status_code, 401)
+            resp = self.client.post('/api/v1/admin/reload', headers={
+                'Authorization': 'Bearer \xc5\xbc\xc3\xb3\xc5\x82w'})
+            self.assertEqual(resp.status_code, 401)
+
+            headers = {'Authorization': 'Bearer secret'}
+            resp = self.client.post('/api/v1/admin/reload?target=nope',
+                                    headers=headers)
+            self.assertEqual(resp.status_code, 400)
+
+            data = utils.get_data()
+            resp = self.client.post('/api/v1/admin/reload?full=1',
+                                    headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            report = json.loads(resp.data)
+            self.assertEqual(report['data']['rows'], 9)
+            self.assertEqual(report['data']['users'], 2)
+            self.assertEqual(report['users']['rows'], 9)
+            self.assertIsNot(utils.get_data(), data)
+            self.assertEqual(utils.get_data(), data)
+
+            resp = self.client.post('/api/v1/admin/reload?target=users',
+                                    headers=headers)
+            self.assertEqual(json.loads(resp.data).keys(), ['users'])
+
+            main.app.config.update({'ADMIN_TOKEN': u'secret'})
+            resp = self.client.post('/api/v1/admin/reload?target=users',
+                                    headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            resp = self.client.post('/api/v1/admin/reload', headers={
+                'Authorization': 'Bearer \xc5\xbc\xc3\xb3\xc5\x82w'})
+            self.assertEqual(resp.status_code, 401)
+        finally:
+            main.app.config.update({'ADMIN_TOKEN': None})
+
+    def test_sighup(self):
+        """
+        Test reloading data on SIGHUP
+        """
+        with patch.object(utils, 'reload_data') as mock_reload_data:
+            utils.handle_sighup(1, None).join()
+        mock_reload_data.assert_called_once_with(utils.RELOAD_TARGETS, False)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -330,6 +603,96 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         dd4 = datetime.time(11, 45, 34)
         self.assertEqual(utils.interval(dd4, dd3), 60*60)
 
+    def test_get_payload(self):
+        """
+        Test serialized chart payloads
+        """
+        payload = utils.get_payload('presence_weekday', 10)
+        self.assertIsInstance(payload, utils.Serialized)
+        self.assertEqual(json.loads(payload)[2], [u'Tue', 30047])
+        self.assertIs(utils.get_payload('presence_weekday', 10), payload)
+
+        utils.get_data.refresh()
+        self.assertIs(utils.get_payload('presence_weekday', 10), payload)
+
+        version = (0, os.path.getsize(TEST_DATA_CSV))
+        with patch.object(storage, 'file_version', return_value=version):
+            utils.get_data.refresh()
+            self.assertIsNot(utils.get_payload('presence_weekday', 10),
+                             payload)
+        utils.get_data.refresh()
+
+    def test_version_events(self):
+        """
+        Test announcing data version changes
+        """
+        old_versions = utils.get_versions()
+        new_versions = (old_versions[0], (0, 0))
+        events = utils.version_events(interval=0, max_age=60)
+        self.assertEqual(next(events), 'retry: 1000\n\n')
+        self.assertIn('event: version\n', next(events))
+
+        with patch.object(utils, 'get_versions', return_value=new_versions):
+            event = next(events)
+        self.assertTrue(event.startswith('event: changed\nid: %s\n' %
+                                         utils.version_id(new_versions)))
+        data = json.loads(event.split('data: ')[1])
+        self.assertEqual(data['users'], [])
+        self.assertTrue(data['users_changed'])
+
+    def test_changed_users(self):
+        """
+        Test comparing digests of users
+        """
+        self.assertIsNone(utils.changed_users(None, {1: 2}))
+        self.assertEqual(utils.changed_users({1: 2, 2: 3}, {1: 2, 2: 4, 3: 1}),
+                         [2, 3])
+
+        digests = utils.get_user_digests()
+        self.assertItemsEqual(digests.keys(), [10, 11])
+
+    def test_warm_up(self):
+        """
+        Test pre-serializing payloads of all users
+        """
+        self.assertEqual(utils.warm_up(), 6)
+        self.assertEqual(utils.warm_up(workers=2), 6)
+
+        with patch.object(utils, 'warm_up') as mock_warm_up:
+            thread = utils.start_warm_up()
+            thread.join()
+        mock_warm_up.assert_called_once_with(0, None)
+        self.assertTrue(utils.READY.is_set())
+
+        # data stored meanwhile by other process is not reloaded again
+        with patch.object(utils.get_data, 'refresh') as mock_refresh:
+            utils.warm_up(max_age=60)
+            self.assertFalse(mock_refresh.called)
+            utils.warm_up(max_age=0)
+            self.assertTrue(mock_refresh.called)
+
+    def test_occupancy(self):
+        """
+        Test presence histogram built with difference array
+        """
+        occupancy = utils.Occupancy()
+        monday = datetime.date(2013, 9, 9)
+        occupancy.add(monday, 9*3600 + 10*60, 10*3600 + 20*60)
+        occupancy.add(monday, 9*3600 + 20*60, 9*3600 + 25*60)
+        occupancy.add(monday + datetime.timedelta(days=7), 9*3600, 9*3600)
+        occupancy.add(monday + datetime.timedelta(days=1), 0, 24*3600-1)
+
+        averages = occupancy.averages()
+        self.assertEqual(averages[0][35], 0)
+        self.assertEqual(averages[0][36], 0.333)
+        self.assertEqual(averages[0][37], 1.333)
+        self.assertEqual(averages[0][38:41], [1, 1, 1])
+        self.assertEqual(averages[0][41], 0.333)
+        self.assertEqual(averages[0][42], 0)
+        self.assertEqual(averages[1][0], 1)
+        self.assertEqual(averages[1][95], 0.999)
+        self.assertEqual(averages[2], [0] * 96)
+
     def test_get_user(self):
         """
         Test for reading data from users.xml
@@ -381,7 +744,10 @@ class PresenceAnalyzerUtilsWithBadDataTestCase(unittest.TestCase):
         self.assertIsInstance(data, dict)
         self.assertItemsEqual(data.keys(), [10, 11])
         self.assertEqual(len(data), 2)
-        self.assertEqual(len(data[10])+len(data[11]), 9)
+        self.assertEqual(len(data[10])+len(data[11]), 7)
+        self.assertNotIn(datetime.date(2013, 9, 12), data[10])
+        self.assertNotIn(datetime.date(2013, 9, 12), data[11])
+        self.assertEqual(data.rejections()['malformed'], 2)
 
     def test_get_user(self):
         """
@@ -420,6 +786,899 @@ class PresenceAnalyzerDecoratorsTestCase(unittest.TestCase):
 
         self.assertEqual(data1, data2)
 
+    def test_cache_refresh(self):
+        """
+        Test forcing and expiring cached values
+        """
+        calls = []
+
+        @decorators.cache(60)
+        def func():
+            """ Counts calls """
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(func(), 1)
+        self.assertEqual(func(), 1)
+        self.assertEqual(func.refresh(), 2)
+        self.assertEqual(func(), 2)
+
+        expired = datetime.datetime.now() + datetime.timedelta(seconds=61)
+        with patch.object(decorators, 'datetime') as mock_datetime:
+            mock_datetime.now.return_value = expired
+            self.assertEqual(func(), 3)
+
+    def test_cache_for(self):
+        """
+        Test caching values tied to source object
+        """
+        source = {'value': [1]}
+
+        @decorators.cache_for(lambda: source['value'])
+        def func(value, item):
+            """ Copies value """
+            return value + [item]
+
+        result = func(2)
+        self.assertEqual(result, [1, 2])
+        self.assertIs(func(2), result)
+        self.assertEqual(func(3), [1, 3])
+
+        source['value'] = [5]
+        self.assertEqual(func(2), [5, 2])
+
+    def test_coalesce(self):
+        """
+        Test sharing result of concurrent identical calls
+        """
+        source = {'value': 1}
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @decorators.coalesce(lambda: source['value'], 60)
+        def func(item):
+            """ Counts calls, waits for release """
+            calls.append(item)
+            started.set()
+            release.wait()
+            return [item, len(calls)]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func(2)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [2])
+        self.assertEqual(results, [[2, 1]] * 5)
+        self.assertIs(results[0], results[4])
+        self.assertEqual(func(3), [3, 2])
+        self.assertEqual(func(2), [2, 1])
+
+        source['value'] = 2
+        self.assertEqual(func(2), [2, 3])
+
+        expired = datetime.datetime.now() + datetime.timedelta(seconds=61)
+        with patch.object(decorators, 'datetime') as mock_datetime:
+            mock_datetime.now.return_value = expired
+            self.assertEqual(func(2), [2, 4])
+
+
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+    """
+    Storage backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'presence.db')
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.config.update({'DATA_DB': self.db_path})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'STORAGE': 'csv'})
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_csv_parallel(self):
+        """
+        Test parsing of CSV file in chunks by pool of processes.
+        """
+        offsets = storage.chunk_offsets(TEST_DATA_CSV, 3)
+        self.assertEqual(len(offsets), 3)
+        self.assertEqual(offsets[0][0], 0)
+        self.assertEqual(offsets[-1][1], os.path.getsize(TEST_DATA_CSV))
+        for start, _ in offsets[1:]:
+            with open(TEST_DATA_CSV) as csvfile:
+                csvfile.seek(start - 1)
+                self.assertEqual(csvfile.read(1), '\n')
+
+        with patch.object(storage, 'cpu_count', return_value=4):
+            self.assertIsNotNone(storage.get_pool(2))
+            self.assertIs(storage.get_pool(2), storage.get_pool(2))
+            self.assertEqual(storage.load_csv(TEST_DATA_CSV, workers=2),
+                             storage.load_csv(TEST_DATA_CSV))
+        with patch.object(storage, 'cpu_count', return_value=1):
+            self.assertIsNone(storage.get_pool(2))
+
+    def test_make_storage(self):
+        """
+        Test choosing storage backend
+        """
+        backend = storage.make_storage(main.app.config)
+        self.assertIsInstance(backend, storage.CSVStorage)
+        self.assertFalse(backend.indexed)
+
+        main.app.config.update({'STORAGE': 'sqlite'})
+        backend = storage.make_storage(main.app.config)
+        self.assertIsInstance(backend, storage.SQLiteStorage)
+        self.assertTrue(backend.indexed)
+
+    def lunch_break_csv(self):
+        """
+        Returns path of test data with second interval of a day added.
+        """
+        path = os.path.join(self.tmp_dir, 'lunch_break.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n11,2013-09-10,14:30:00,16:00:00\n')
+        return path
+
+    def test_sqlite_storage(self):
+        """
+        Test importing CSV file into SQLite and querying it
+        """
+        backend = storage.SQLiteStorage(self.db_path)
+        self.assertEqual(backend.import_csv(TEST_DATA_CSV, chunk_size=100), 9)
+        self.assertEqual(backend.import_csv(TEST_DATA_CSV), 9)
+
+        data = storage.load_csv(TEST_DATA_CSV)
+        self.assertEqual(backend.load(), data)
+        self.assertItemsEqual(backend.user_ids(), [10, 11])
+        self.assertEqual(backend.user_data(11), data[11])
+        self.assertEqual(backend.user_data(12), {})
+
+        user_data = backend.user_data(11, start=datetime.date(2013, 9, 10),
+                                      end=datetime.date(2013, 9, 12))
+        self.assertItemsEqual(user_data.keys(), [
+            datetime.date(2013, 9, 10),
+            datetime.date(2013, 9, 11),
+            datetime.date(2013, 9, 12),
+        ])
+        self.assertEqual(user_data, storage.filter_dates(
+            data[11], datetime.date(2013, 9, 10), datetime.date(2013, 9, 12)
+        ))
+
+        # day with lunch break keeps both intervals
+        path = self.lunch_break_csv()
+        self.assertEqual(backend.import_csv(path), 10)
+        data = storage.load_csv(path)
+        self.assertEqual(backend.load(), data)
+        self.assertEqual(backend.user_data(11), data[11])
+        day = backend.user_data(11)[datetime.date(2013, 9, 10)]
+        self.assertEqual(utils.presence_time(day), 16564 + 5400)
+
+        # failed import keeps previous data
+        parse_chunk = storage.parse_chunk
+        with patch.object(storage, 'parse_chunk') as mock_parse_chunk:
+            mock_parse_chunk.side_effect = [parse_chunk((path, 0, 100)),
+                                            IOError('gone')]
+            with self.assertRaises(IOError):
+                backend.import_csv(path, chunk_size=100)
+        self.assertEqual(backend.load(), data)
+
+    def test_sqlite_migration(self):
+        """
+        Test migrating SQLite database keeping one row per day
+        """
+        connection = sqlite3.connect(self.db_path)
+        connection.execute(
+            'CREATE TABLE presence (user_id INTEGER NOT NULL, date INTEGER '
+            'NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL, '
+            'PRIMARY KEY (user_id, date)) WITHOUT ROWID')
+        connection.execute('INSERT INTO presence VALUES (10, 735121, '
+                           '32400, 43200)')
+        connection.commit()
+        connection.close()
+
+        backend = storage.SQLiteStorage(self.db_path)
+        self.assertEqual(backend.user_data(10), {
+            datetime.date(2013, 9, 10): {'start': datetime.time(9),
+                                         'end': datetime.time(12)},
+        })
+        connection = backend.connect()
+        connection.execute('INSERT INTO presence VALUES (10, 735121, '
+                           '46800, 61200)')
+        connection.commit()
+        connection.close()
+        day = backend.user_data(10)[datetime.date(2013, 9, 10)]
+        self.assertEqual(utils.presence_time(day), 7 * 3600)
+
+    def test_arrow_storage(self):
+        """
+        Test converting CSV file into Parquet and Arrow IPC files
+        """
+        csv_path = self.lunch_break_csv()
+        data = storage.load_csv(csv_path)
+        for name in ('presence.parquet', 'presence.arrow'):
+            path = os.path.join(self.tmp_dir, name)
+            self.assertEqual(
+                storage.export_arrow(csv_path, path, chunk_size=100), 10)
+
+            main.app.config.update({'DATA_CSV': path})
+            backend = storage.make_storage(main.app.config)
+            self.assertIsInstance(backend, storage.ArrowStorage)
+            self.assertEqual(backend.load(), data)
+            with patch.object(backend, 'read_table') as mock_read_table:
+                self.assertIs(backend.load(), backend.load())
+            self.assertFalse(mock_read_table.called)
+
+    def test_indexed_csv_storage(self):
+        """
+        Test reading users of CSV file through offset index
+        """
+        path = os.path.join(self.tmp_dir, 'presence.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path, 'STORAGE': 'indexed_csv'})
+        backend = storage.make_storage(main.app.config)
+        self.assertIsInstance(backend, storage.IndexedCSVStorage)
+
+        index = storage.build_index(path)
+        self.assertEqual(index['users'], {10: [[0, 99]], 11: [[99, 295]]})
+        self.assertIsNone(storage.read_index(path))
+
+        data = storage.load_csv(path)
+        self.assertItemsEqual(backend.user_ids(), [10, 11])
+        self.assertEqual(storage.read_index(path), index)
+        self.assertEqual(backend.user_data(11), data[11])
+        self.assertEqual(backend.user_data(12), {})
+
+        with patch.object(storage, 'parse_chunk') as mock_parse_chunk:
+            self.assertEqual(backend.user_data(11), data[11])
+        self.assertFalse(mock_parse_chunk.called)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\r\n12,2013-09-13,13:16:56,15:04:02')
+        build_index = storage.build_index
+        with patch.object(storage, 'build_index') as mock_build_index:
+            mock_build_index.side_effect = build_index
+            threads = [threading.Thread(target=backend.user_ids)
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mock_build_index.call_count, 1)
+        self.assertItemsEqual(backend.user_ids(), [10, 11, 12])
+        self.assertEqual(len(backend.user_data(12)), 1)
+        self.assertEqual(storage.read_index(path)['users'][12], [[297, 328]])
+        self.assertFalse([name for name in os.listdir(self.tmp_dir)
+                          if name.endswith('.tmp')])
+
+    def test_csv_appended(self):
+        """
+        Test loading only lines appended to CSV file
+        """
+        path = os.path.join(self.tmp_dir, 'presence.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(open(TEST_DATA_CSV).read() + '\n')
+        backend = storage.CSVStorage(path)
+
+        data = backend.load()
+        self.assertIsNone(data.changes)
+        self.assertIs(backend.load(), data)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-13,08:00:00,16:00:00\n'
+                          '12,2013-09-10,08:00:00,16:00:00\n')
+        appended = backend.load()
+        self.assertEqual(appended.base_version, data.version)
+        self.assertEqual(len(appended.changes), 2)
+        self.assertEqual(appended, storage.load_csv(path))
+        self.assertIs(appended[11], data[11])
+        self.assertNotEqual(appended[10], data[10])
+        self.assertNotIn(12, data)
+
+        with open(path, 'w') as csvfile:
+            csvfile.write(open(TEST_DATA_CSV).read() * 2)
+        self.assertIsNone(backend.load().changes)
+
+    def test_csv_validation(self):
+        """
+        Test rejecting invalid rows of CSV file
+        """
+        path = os.path.join(self.tmp_dir, 'presence.csv')
+        quarantine = os.path.join(self.tmp_dir, 'quarantine.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('user_id,date,start,end\n'
+                          '10,2013-09-10,09:00:00,17:00:00\n'
+                          '10,2013-09-11,x:00:00,17:00:00\n'
+                          '10,2013-09-12,25:00:00,17:00:00\n'
+                          '10,2013-02-30,09:00:00,17:00:00\n'
+                          '10,2013-09-13,17:00:00,09:00:00\n'
+                          '10,2013-09-10,09:00:00,17:00:00\n'
+                          '11,2013-9-10,9:00:00,17:00:00\n')
+        backend = storage.CSVStorage(path, quarantine=quarantine)
+
+        data = backend.load()
+        self.assertEqual(data.rows(), 2)
+        self.assertEqual(data[10][datetime.date(2013, 9, 10)]['start'],
+                         datetime.time(9, 0, 0))
+        self.assertEqual(data[11][datetime.date(2013, 9, 10)]['start'],
+                         datetime.time(9, 0, 0))
+        self.assertEqual(data.rejections(), {
+            'malformed': 1,
+            'out_of_range': 2,
+            'end_before_start': 1,
+            'duplicate_date': 1,
+        })
+        with open(quarantine) as csvfile:
+            rows = list(csv.reader(csvfile))
+        self.assertEqual([row[:2] for row in rows], [
+            ['2', 'malformed'],
+            ['3', 'out_of_range'],
+            ['4', 'out_of_range'],
+            ['5', 'end_before_start'],
+            ['6', 'duplicate_date'],
+        ])
+        self.assertEqual(rows[0][2], '10,2013-09-11,x:00:00,17:00:00')
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('11,2013-09-11,17:00:00,09:00:00\n')
+        self.assertEqual(backend.load().rejections()['end_before_start'], 2)
+        with open(quarantine) as csvfile:
+            self.assertEqual(len(list(csvfile)), 6)
+
+        main.app.config.update({'DATA_CSV': path})
+        utils.get_data.refresh()
+        client = main.app.test_client()
+        resp = client.get('/api/v1/ingest_stats')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['rows'], 2)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.get_data.refresh()
+
+    def test_csv_intervals(self):
+        """
+        Test loading several presence intervals of a day
+        """
+        path = os.path.join(self.tmp_dir, 'presence.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,12:00:00\n'
+                          '10,2013-09-10,13:00:00,17:00:00\n'
+                          '10,2013-09-11,09:00:00,17:00:00\n'
+                          '10,2013-09-10,11:00:00,12:30:00\n')
+        backend = storage.CSVStorage(path)
+        data = backend.load()
+        self.assertEqual(data.rows(), 4)
+        entry = data[10][datetime.date(2013, 9, 10)]
+        self.assertEqual(entry['start'], datetime.time(9, 0, 0))
+        self.assertEqual(entry['end'], datetime.time(17, 0, 0))
+        self.assertEqual(list(entry['intervals']), [
+            (32400, 43200), (46800, 61200), (39600, 45000)])
+        self.assertEqual(entry['intervals'].union(),
+                         [(32400, 45000), (46800, 61200)])
+        self.assertEqual(utils.presence_time(entry), 7 * 3600 + 1800)
+        self.assertNotIn('intervals', data[10][datetime.date(2013, 9, 11)])
+        self.assertEqual(
+            sketches.entry_values(entry), (32400, 61200, 7 * 3600 + 1800))
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('10,2013-09-11,18:00:00,19:00:00\n'
+                          '10,2013-09-10,13:00:00,17:00:00\n')
+        appended = backend.load()
+        self.assertEqual(appended, storage.load_csv(path))
+        self.assertEqual(len(appended.changes), 1)
+        self.assertEqual(appended.rejections()['duplicate_date'], 1)
+        self.assertNotIn('intervals', data[10][datetime.date(2013, 9, 11)])
+        self.assertEqual(
+            utils.presence_time(appended[10][datetime.date(2013, 9, 11)]),
+            9 * 3600)
+
+    def test_multi_csv(self):
+        """
+        Test loading presence data from several CSV files
+        """
+        data_dir = os.path.join(self.tmp_dir, 'data')
+        os.mkdir(data_dir)
+        lines = open(TEST_DATA_CSV).read().splitlines()
+        with open(os.path.join(data_dir, '1.csv'), 'w') as csvfile:
+            csvfile.write('\n'.join(lines[:5]) + '\n')
+        with open(os.path.join(data_dir, '2.csv'), 'w') as csvfile:
+            csvfile.write('\n'.join(lines[4:]) + '\n')
+
+        main.app.config.update({'DATA_CSV': data_dir})
+        backend = storage.make_storage(main.app.config)
+        self.assertIsInstance(backend, storage.MultiCSVStorage)
+        data = backend.load()
+        self.assertEqual(data, storage.load_csv(TEST_DATA_CSV))
+        self.assertEqual(data.rejections()['duplicate_date'], 1)
+        self.assertIs(backend.load(), data)
+
+        with open(os.path.join(data_dir, '3.csv'), 'w') as csvfile:
+            csvfile.write('12,2013-09-10,08:00:00,16:00:00\n')
+        parse_chunk = storage.parse_chunk
+        with patch.object(storage, 'parse_chunk') as mock_parse_chunk:
+            mock_parse_chunk.side_effect = parse_chunk
+            added = backend.load()
+        self.assertEqual(mock_parse_chunk.call_count, 1)
+        self.assertEqual(len(added[12]), 1)
+        self.assertEqual(added[11], data[11])
+
+        # rotated out file is forgotten
+        first = os.path.join(data_dir, '1.csv')
+        os.remove(first)
+        self.assertIn(first, storage.LOADED)
+        self.assertNotIn(10, backend.load())
+        self.assertNotIn(first, storage.LOADED)
+        with open(first, 'w') as csvfile:
+            csvfile.write('\n'.join(lines[:5]) + '\n')
+
+        pattern = os.path.join(data_dir, '[12].csv')
+        parallel = storage.MultiCSVStorage(pattern, workers=2)
+        storage.clear_caches()
+        with patch.object(storage, 'cpu_count', return_value=4):
+            self.assertEqual(parallel.load(), data)
+
+    def test_sqlite_views(self):
+        """
+        Test serving views from SQLite storage
+        """
+        main.app.config.update({'STORAGE': 'sqlite'})
+        client = main.app.test_client()
+        self.assertIsNone(storage.SQLiteStorage(self.db_path).version())
+        resp = client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [])
+
+        storage.SQLiteStorage(self.db_path).import_csv(TEST_DATA_CSV)
+        self.assertIs(utils.get_storage(), utils.get_storage())
+
+        with patch.object(utils, 'get_data') as mock_get_data:
+            resp = client.get('/api/v1/presence_weekday/11')
+            self.assertEqual(utils.warm_up(), 6)
+        self.assertFalse(mock_get_data.called)
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(json.loads(resp.data)[4], [u'Thu', 45968])
+
+
+class PresenceAnalyzerSketchesTestCase(unittest.TestCase):
+    """
+    Quantile sketches tests.
+    """
+
+    def test_histogram(self):
+        """
+        Test quantiles of fixed-bin histogram
+        """
+        histogram = sketches.Histogram()
+        self.assertEqual(histogram.quantile(0.5), 0)
+        for value in range(0, 6000, 60):
+            histogram.add(value)
+        self.assertEqual(histogram.total, 100)
+        self.assertEqual(histogram.quantile(0.1), 600)
+        self.assertEqual(histogram.quantile(0.5), 3000)
+        self.assertEqual(histogram.quantile(1), 6000)
+
+        other = histogram.copy()
+        other.remove(0)
+        self.assertEqual(histogram.total, 100)
+        self.assertEqual(other.total, 99)
+
+        histogram.merge(other)
+        self.assertEqual(histogram.total, 199)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[1], 2)
+
+    def test_presence_sketches(self):
+        """
+        Test updating sketches with changes
+        """
+        data = storage.load_csv(TEST_DATA_CSV)
+        built = sketches.PresenceSketches.build(data.items())
+        date = datetime.date(2013, 9, 10)
+        entry = {'start': datetime.time(8), 'end': datetime.time(16)}
+
+        updated = built.updated([(10, date, data[10][date], entry),
+                                 (12, date, None, entry)])
+        # quantiles are interpolated within one minute bin of single entry
+        self.assertEqual(built.quantiles(10)[1]['start'],
+                         [34746, 34770, 34794])
+        self.assertEqual(updated.quantiles(10)[1]['start'],
+                         [28806, 28830, 28854])
+        self.assertEqual(updated.quantiles(12)[1]['duration'],
+                         [28806, 28830, 28854])
+        self.assertEqual(updated.quantiles(11), built.quantiles(11))
+        self.assertEqual(built.quantiles(12), {})
+
+
+class PresenceAnalyzerAnomaliesTestCase(unittest.TestCase):
+    """
+    Anomaly detection tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.get_data.refresh()
+
+    def test_presence_anomalies(self):
+        """
+        Test anomalies found in statistics and their updates
+        """
+        # five weeks of Monday to Thursday, starting 3 hours later in the
+        # last 10 days
+        days = [datetime.date(2013, 9, 2) + datetime.timedelta(days=i)
+                for i in range(35) if i % 7 < 4]
+        user_data = {}
+        for i, date in enumerate(days):
+            start = 9 if i < 10 else 12
+            user_data[date] = {'start': datetime.time(start),
+                               'end': datetime.time(start + 8)}
+        user_data[days[0]] = {'start': datetime.time(6),
+                              'end': datetime.time(23, 30)}
+        rejected = [(4, 'malformed', 'x'),
+                    (7, 'end_before_start', '10,2013-09-11,17:00:00,9:00')]
+        built = anomalies.PresenceAnomalies.build(
+            [(10, user_data)], rejected)
+        report = built.report()
+        self.assertEqual(report['long_days'], [
+            {'user_id': 10, 'date': '2013-09-02', 'hours': 17.5},
+        ])
+        self.assertEqual(report['end_before_start'], [
+            {'line': 7, 'row': '10,2013-09-11,17:00:00,9:00'},
+        ])
+        self.assertEqual(report['pattern_shifts'], [
+            {'user_id': 10, 'recent_start': '12:00', 'usual_start': '08:42'},
+        ])
+        self.assertEqual(report['missing_weekdays'], [
+            {'user_id': 10, 'weekdays': ['Fri']},
+        ])
+
+        entry = {'start': datetime.time(5), 'end': datetime.time(22)}
+        friday = datetime.date(2013, 9, 6)
+        updated = built.updated(
+            [(10, days[0], user_data[days[0]], entry),
+             (10, friday, None, entry),
+             (11, friday, None, entry)],
+            [(8, 'end_before_start', '11,2013-09-12,17:00:00,9:00')])
+        report = updated.report()
+        self.assertEqual(report['long_days'], [
+            {'user_id': 10, 'date': '2013-09-02', 'hours': 17.0},
+            {'user_id': 10, 'date': '2013-09-06', 'hours': 17.0},
+            {'user_id': 11, 'date': '2013-09-06', 'hours': 17.0},
+        ])
+        self.assertEqual(len(report['end_before_start']), 2)
+        self.assertEqual(report['missing_weekdays'], [])
+        self.assertEqual(updated.checked, 3)
+        # statistics built before stay untouched
+        self.assertEqual(built.report()['long_days'][0]['hours'], 17.5)
+        self.assertEqual(built.users[10].days, 20)
+
+        # incremental updates match statistics built from scratch
+        user_data[days[0]] = entry
+        user_data[friday] = entry
+        rebuilt = anomalies.PresenceAnomalies.build(
+            [(10, user_data), (11, {friday: entry})])
+        del report['end_before_start']
+        rebuilt_report = rebuilt.report()
+        del rebuilt_report['end_before_start']
+        self.assertEqual(report, rebuilt_report)
+
+    def test_anomalies_view(self):
+        """
+        Test anomalies served while data is appended
+        """
+        path = os.path.join(self.tmp_dir, 'presence.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,06:00:00,23:00:00\n'
+                          '10,2013-09-11,17:00:00,09:00:00\n')
+        main.app.config.update({'DATA_CSV': path})
+        utils.get_data.refresh()
+        client = main.app.test_client()
+        resp = client.get('/api/v1/anomalies')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['long_days'], [
+            {'user_id': 10, 'date': '2013-09-10', 'hours': 17.0},
+        ])
+        self.assertEqual(data['end_before_start'], [
+            {'line': 1, 'row': '10,2013-09-11,17:00:00,09:00:00'},
+        ])
+
+        previous = utils.get_anomalies()
+        with open(path, 'a') as csvfile:
+            csvfile.write('11,2013-09-11,17:00:00,09:00:00\n'
+                          '11,2013-09-12,05:00:00,22:00:00\n')
+        utils.get_data.refresh()
+        data = json.loads(client.get('/api/v1/anomalies').data)
+        self.assertEqual(len(data['long_days']), 2)
+        self.assertEqual(len(data['end_before_start']), 2)
+        self.assertIs(utils.get_anomalies().users[10], previous.users[10])
+
+
+class PresenceAnalyzerAdmissionTestCase(unittest.TestCase):
+    """
+    Admission control tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.config.update({'ADMISSION': True, 'ADMISSION_RATE': 1,
+                                'ADMISSION_BURST': 2, 'ADMISSION_SLOTS': 1,
+                                'ADMISSION_QUEUE': 1, 'ADMISSION_TIMEOUT': 1})
+        admission.CONTROLLERS.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'ADMISSION': False})
+
+    def test_token_bucket(self):
+        """
+        Test rate limiting with token bucket
+        """
+        with patch.object(admission, 'time') as mock_time:
+            mock_time.return_value = 100.0
+            bucket = admission.TokenBucket(2, 3)
+            self.assertEqual([bucket.take() for _ in range(4)],
+                             [0, 0, 0, 0.5])
+            mock_time.return_value = 100.5
+            self.assertEqual(bucket.take(), 0)
+            self.assertEqual(bucket.take(), 0.5)
+
+    def test_acquire(self):
+        """
+        Test bounding number of requests processed at once
+        """
+        controller = admission.AdmissionController(slots=1, queue=1,
+                                                   timeout=5)
+        self.assertTrue(controller.acquire())
+        admitted = []
+        waiting = threading.Thread(
+            target=lambda: admitted.append(controller.acquire(True)))
+        waiting.start()
+        while not controller.waiting[True]:
+            waiting.join(0.01)
+
+        controller.timeout = 0
+        self.assertFalse(controller.acquire())
+        controller.release()
+        waiting.join()
+        self.assertEqual(admitted, [True])
+        self.assertEqual(controller.active, 1)
+
+    def test_views(self):
+        """
+        Test rejecting API requests
+        """
+        for _ in range(2):
+            resp = self.client.get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 200)
+        for _ in range(3):
+            resp = self.client.get('/api/v1/ready')
+            self.assertNotEqual(resp.status_code, 429)
+
+        controller = admission.get_controller(main.app.config)
+        self.assertEqual(controller.active, 0)
+        controller.active = 1
+        resp = self.client.get('/api/v1/presence_start_end/10')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        controller.active = 0
+
+        # streamed response keeps its slot until it is sent
+        resp = self.client.get('/api/v1/export.csv', buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(controller.active, 1)
+        self.assertIn('10,2013-09-10', resp.data)
+        resp.close()
+        self.assertEqual(controller.active, 0)
+
+
+class LocalRedis(object):
+    """
+    Stand-in of Redis client keeping values in memory, expiry is ignored.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns value of key """
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):  # pylint: disable=W0613
+        """ Sets value of key, only when it is missing with nx """
+        with self.lock:
+            if nx and key in self.values:
+                return None
+            self.values[key] = str(value)
+            return True
+
+    def delete(self, key):
+        """ Deletes key """
+        with self.lock:
+            self.values.pop(key, None)
+
+    def eval(self, script, numkeys, key, token):  # pylint: disable=W0613
+        """ Runs RedisCache.RELEASE_SCRIPT: deletes key holding token """
+        with self.lock:
+            if self.values.get(key) == token:
+                del self.values[key]
+                return 1
+            return 0
+
+
+class PresenceAnalyzerCachesTestCase(unittest.TestCase):
+    """
+    Cache backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.server = LocalRedis()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        decorators.set_cache_backend(caches.MemoryCache())
+
+    def test_serialization(self):
+        """
+        Test serializing presence data
+        """
+        data = storage.load_csv(TEST_DATA_CSV)
+        loaded = caches.loads(caches.dumps(data))
+        self.assertIsInstance(loaded, storage.PresenceData)
+        self.assertEqual(loaded, data)
+        self.assertEqual(loaded.version, data.version)
+
+    def test_shared_cache(self):
+        """
+        Test sharing cached values between processes
+        """
+        calls = []
+
+        @decorators.cache(60)
+        def func(item):
+            """ Counts calls """
+            calls.append(item)
+            return {'item': item, 'calls': len(calls)}
+
+        first = caches.RedisCache(self.server)
+        second = caches.RedisCache(self.server)
+        decorators.set_cache_backend(first)
+        self.assertEqual(func(1), {'item': 1, 'calls': 1})
+        decorators.set_cache_backend(second)
+        self.assertEqual(func(1), {'item': 1, 'calls': 1})
+        self.assertIs(func(1), func(1))
+        self.assertEqual(calls, [1])
+
+        self.assertEqual(func.refresh(1), {'item': 1, 'calls': 2})
+        decorators.set_cache_backend(first)
+        self.assertEqual(func(1), {'item': 1, 'calls': 2})
+        self.assertFalse(func.expired(1))
+        self.assertTrue(func.expired(2))
+
+    def test_lock(self):
+        """
+        Test refreshing value once while others wait for it
+        """
+        calls = []
+        release = threading.Event()
+
+        @decorators.cache(60)
+        def func():
+            """ Counts calls, waits for release """
+            calls.append(1)
+            release.wait()
+            return len(calls)
+
+        backend = caches.RedisCache(self.server)
+        decorators.set_cache_backend(backend)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while not calls:
+            threads[0].join(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1, 1, 1])
+        self.assertEqual(
+            [key for key in self.server.values if ':lock:' in key], [])
+
+        # refreshes started while other one runs reuse its value
+        release.clear()
+        locking = []
+        locked = backend.locked
+        threads = [threading.Thread(target=lambda: results.append(
+            func.refresh())) for _ in range(3)]
+        with patch.object(backend, 'locked') as mock_locked:
+            mock_locked.side_effect = lambda key: locking.append(key) or \
+                locked(key)
+            threads[0].start()
+            while len(calls) < 2:
+                threads[0].join(0.01)
+            for thread in threads[1:]:
+                thread.start()
+            while len(locking) < 3:
+                threads[0].join(0.01)
+            release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(results[3:], [2, 2, 2])
+        self.assertLess(func.age(), 60)
+
+    def test_lock_takeover(self):
+        """
+        Test keeping lock taken over by other process
+        """
+        backend = caches.RedisCache(self.server)
+        backend.LOCK_TIMEOUT = 0
+        with backend.locked('key'):
+            with backend.locked('key'):
+                pass
+            self.server.set('presence_analyzer:lock:key', 'other')
+        self.assertEqual(self.server.get('presence_analyzer:lock:key'),
+                         'other')
+
+    def test_make_cache(self):
+        """
+        Test choosing cache backend
+        """
+        self.assertIsInstance(caches.make_cache({}), caches.MemoryCache)
+        with patch.object(caches, 'import_redis') as mock_import_redis:
+            backend = caches.make_cache(
+                {'CACHE_URL': 'redis://localhost:6379/0'})
+        self.assertIsInstance(backend, caches.RedisCache)
+        mock_import_redis().StrictRedis.from_url.assert_called_once_with(
+            'redis://localhost:6379/0')
+
 
 class PresenceAnalyzerHelpersTestCase(unittest.TestCase):
     """
@@ -448,6 +1707,22 @@ class PresenceAnalyzerHelpersTestCase(unittest.TestCase):
         self.assertEqual(key3, assert3)
         self.assertEqual(key4, assert4)
 
+    def test_lru_cache(self):
+        """
+        Test dropping least recently used items
+        """
+        lru = helpers.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+        lru.clear()
+        self.assertEqual(lru.get('a', 0), 0)
+
 
 def suite():
     """
@@ -459,6 +1734,11 @@ def suite():
     test_suite.addTest(unittest.makeSuite(
         PresenceAnalyzerUtilsWithBadDataTestCase))
     test_suite.addTest(unittest.makeSuite(PresenceAnalyzerDecoratorsTestCase))
+    test_suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
+    test_suite.addTest(unittest.makeSuite(PresenceAnalyzerSketchesTestCase))
+    test_suite.addTest(unittest.makeSuite(PresenceAnalyzerAnomaliesTestCase))
+    test_suite.addTest(unittest.makeSuite(PresenceAnalyzerAdmissionTestCase))
+    test_suite.addTest(unittest.makeSuite(PresenceAnalyzerCachesTestCase))
 
     return test_suite
 
@@ -3,28 +3,135 @@
 Helper functions used in views.
 """
 
-import csv
+import calendar
 from json import dumps
 from functools import wraps
-from datetime import datetime
-from lxml import etree
-from flask import Response
-from presence_analyzer.decorators import cache
+from threading import Event, Lock, Thread
+from multiprocessing.pool import ThreadPool
+import time
+from flask import Response, request
+from presence_analyzer.anomalies import PresenceAnomalies
+from presence_analyzer.decorators import cache, cache_for, cache_updates
+from presence_analyzer.sketches import PresenceSketches, METRICS
+from presence_analyzer.helpers import Serialized, VersionedDict
+from presence_analyzer.storage import get_storage_backend, filter_dates, \
+    file_version, clear_caches
 
 from presence_analyzer.main import app
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
+# length of presence_hours bins in seconds and their number per day
+HOUR_BIN = 15 * 60
+HOUR_BINS = 24 * 3600 // HOUR_BIN
+
+# set once the app is warmed up (or when warm-up is not used at all)
+READY = Event()
+READY.set()
+
+# what reload_data() can reload; only one reload runs at a time
+RELOAD_TARGETS = ('data', 'users')
+RELOAD_LOCK = Lock()
+
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+MSGPACK = 'application/x-msgpack'
+
+
+def import_msgpack():
+    """
+    Imports msgpack, returns None when it is not installed.
+    """
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+# msgpack module, None when it is not installed; imported once, as failed
+# import would scan sys.path again on every attempt
+msgpack = import_msgpack()  # pylint: disable=C0103
+
+# mimetypes which responses can be encoded in
+RESPONSE_FORMATS = [JSON, NDJSON] + ([MSGPACK] if msgpack else [])
+
+
+def response_formats():
+    """
+    Returns mimetypes which responses can be encoded in.
+    """
+    return RESPONSE_FORMATS
+
+
+def response_format():
+    """
+    Returns mimetype chosen by Accept header of current request.
+
+    JSON is used when client accepts none of supported formats.
+    """
+    return request.accept_mimetypes.best_match(response_formats()) or JSON
+
+
+def encode(result, mimetype=JSON):
+    """
+    Encodes result in given format.
+
+    NDJSON puts each item of a list in separate line.
+    """
+    if mimetype == NDJSON:
+        items = result if isinstance(result, list) else [result]
+        return ''.join('%s\n' % dumps(item) for item in items)
+    if mimetype == MSGPACK:
+        return msgpack.packb(result)
+    return dumps(result)
+
+
+def encode_records(records, mimetype=JSON):
+    """
+    Generates {'user_id': ..., 'data': ...} records with serialized data.
+
+    Takes iterable of (user_id, data encoded in given format) pairs, so
+    encoded payloads are reused and response is produced incrementally.
+    JSON records are yielded as a list, NDJSON ones one per line and
+    MessagePack ones as a stream of maps.
+    """
+    if mimetype == MSGPACK:
+        packb = msgpack.packb
+        for user_id, data in records:
+            yield '\x82%s%s%s%s' % (packb('user_id'), packb(user_id),
+                                    packb('data'), data)
+        return
+
+    if mimetype == NDJSON:
+        for user_id, data in records:
+            yield '{"user_id": %d, "data": [%s]}\n' % (
+                user_id, ', '.join(data.splitlines()))
+        return
+
+    separator = '['
+    for user_id, data in records:
+        yield '%s{"user_id": %d, "data": %s}' % (separator, user_id, data)
+        separator = ', '
+    yield ']' if separator != '[' else '[]'
+
 
 def jsonify(function):
     """
-    Creates a response with the JSON representation of wrapped function result.
+    Creates a response with the representation of wrapped function result.
+
+    Format (JSON, NDJSON or MessagePack) is negotiated with Accept header,
+    already encoded results are expected in that format.
     """
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        mimetype = response_format()
+        result = function(*args, **kwargs)
+        if not isinstance(result, Serialized):
+            result = encode(result, mimetype)
+        return Response(result, mimetype=mimetype)
     return inner
 
 
@@ -46,26 +153,79 @@ def get_data():
             },
         }
     }
+
+    Data is read from storage backend chosen by STORAGE setting.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    return get_storage().load()
+
+
+def get_storage():
+    """
+    Returns presence data storage backend configured for the app.
+    """
+    return get_storage_backend(app.config)
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def data_cached():
+    """
+    Tells whether presence data can be served without loading it.
+    """
+    return get_storage().indexed or not get_data.expired()
 
-    return data
+
+def get_data_version():
+    """
+    Returns version of presence data served by get_user_data().
+    """
+    storage = get_storage()
+    if storage.indexed:
+        return storage.version()
+    return get_data().version
+
+
+def response_version():
+    """
+    Returns negotiated response format and version of presence data.
+
+    Together with view arguments it identifies response of API view.
+    """
+    return response_format(), get_data_version()
+
+
+def get_user_ids():
+    """
+    Returns ids of users with any presence entries.
+    """
+    storage = get_storage()
+    if storage.indexed:
+        return storage.user_ids()
+    return get_data().keys()
+
+
+def get_user_data(user_id, start=None, end=None):
+    """
+    Returns presence entries of given user, optionally between given dates.
+
+    Indexed storage backends read only rows of given user, others are
+    served from get_data().
+    """
+    storage = get_storage()
+    if storage.indexed:
+        return storage.user_data(user_id, start, end)
+    return filter_dates(get_data().get(user_id, {}), start, end)
+
+
+def get_ingest_stats():
+    """
+    Returns numbers of accepted and rejected (by reason) rows of last
+    load of presence data.
+
+    Indexed storage backends do not load whole data, so both are None.
+    """
+    if get_storage().indexed:
+        return {'rows': None, 'rejected': None}
+    data = get_data()
+    return {'rows': data.rows(), 'rejected': data.rejections()}
 
 
 def group_by_weekday(items):
@@ -74,9 +234,7 @@ def group_by_weekday(items):
     """
     result = {i: [] for i in range(7)}
     for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+        result[date.weekday()].append(presence_time(items[date]))
     return result
 
 
@@ -94,6 +252,17 @@ def interval(start, end):
     return seconds_since_midnight(end) - seconds_since_midnight(start)
 
 
+def presence_time(entry):
+    """
+    Calculates presence time of day entry in seconds.
+
+    Days with several intervals count time covered by any of them.
+    """
+    if 'intervals' in entry:
+        return entry['intervals'].duration()
+    return interval(entry['start'], entry['end'])
+
+
 def mean(items):
     """
     Calculates arithmetic mean. Returns zero for empty lists.
@@ -101,6 +270,27 @@ def mean(items):
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
 
+def mean_time_weekday(user_data):
+    """
+    Calculate mean presence time of user grouped by weekday.
+    """
+    weekdays = group_by_weekday(user_data)
+    return [(calendar.day_abbr[weekday], mean(intervals))
+            for weekday, intervals in weekdays.items()]
+
+
+def presence_weekday(user_data):
+    """
+    Calculate total presence time of user grouped by weekday.
+    """
+    weekdays = group_by_weekday(user_data)
+    result = [(calendar.day_abbr[weekday], sum(intervals))
+              for weekday, intervals in weekdays.items()]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
 def get_start_end_mean_time(user_data):
     """
     Calculate mean value start/end user's working time
@@ -122,11 +312,84 @@ def get_start_end_mean_time(user_data):
     ]
 
 
+class Occupancy(object):
+    """
+    Histogram of presence by weekday and time of day.
+
+    Entries are added to a difference array in O(1) each, bins are
+    filled with a single prefix-sum pass afterwards.
+    """
+
+    def __init__(self):
+        # changes of number of entries covering whole bins
+        self.diff = [0] * (7 * HOUR_BINS + 1)
+        # seconds of entries covering bins partially
+        self.edges = [0] * (7 * HOUR_BINS)
+        self.dates = set()
+
+    def add(self, date, start, end):
+        """
+        Adds entry given as seconds since midnight of start and end.
+        """
+        if end <= start:
+            return
+
+        self.dates.add(date)
+        offset = date.weekday() * HOUR_BINS
+        first, last = start // HOUR_BIN, end // HOUR_BIN
+        if first == last:
+            self.edges[offset + first] += end - start
+            return
+
+        self.edges[offset + first] += (first + 1) * HOUR_BIN - start
+        self.edges[offset + last] += end - last * HOUR_BIN
+        self.diff[offset + first + 1] += 1
+        self.diff[offset + last] -= 1
+
+    def averages(self):
+        """
+        Returns mean number of people present in each bin by weekday.
+
+        Presence time in bin is divided by bin length and by number of days
+        of given weekday with any entries.
+        """
+        days = [0] * 7
+        for date in self.dates:
+            days[date.weekday()] += 1
+
+        result = []
+        covering = 0
+        for weekday in range(7):
+            row = []
+            for i in range(weekday * HOUR_BINS, (weekday + 1) * HOUR_BINS):
+                covering += self.diff[i]
+                seconds = covering * HOUR_BIN + self.edges[i]
+                row.append(round(float(seconds) / HOUR_BIN / days[weekday], 3)
+                           if days[weekday] else 0)
+            result.append(row)
+        return result
+
+
+def presence_hours(averages):
+    """
+    Formats Occupancy.averages() as rows of time of day and weekday values.
+    """
+    result = [['Time'] + list(calendar.day_abbr)]
+    for i in range(HOUR_BINS):
+        seconds = i * HOUR_BIN
+        result.append(['%02d:%02d' % (seconds // 3600, seconds % 3600 // 60)] +
+                      [averages[weekday][i] for weekday in range(7)])
+    return result
+
+
 @cache(60*60)
 def get_users():
     """
     Return dict of users from users.xml
     """
+    from lxml import etree
+
+    version = file_version(app.config['DATA_XML'])
     with open(app.config['DATA_XML']) as users_fh:
         users = etree.XML(users_fh.read())
 
@@ -137,9 +400,374 @@ def get_users():
         int(server.find('port').text),
     )
 
-    return {
+    return VersionedDict({
         int(u.get('id')):
             {'name': u.find('name').text,
              'avatar': "%s%s" % (base_url, u.find('avatar').text)}
         for u in users.find('users')
+    }, version)
+
+
+# chart payloads served by views, by name
+PAYLOADS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': get_start_end_mean_time,
+}
+
+
+@cache_for(get_data_version)
+def get_payload(version, name, user_id,  # pylint: disable=W0613
+                mimetype=JSON):
+    """
+    Return chart payload of given user, serialized in given format.
+
+    Payloads are kept until version of presence data changes.
+    """
+    return Serialized(encode(PAYLOADS[name](get_user_data(user_id)),
+                             mimetype))
+
+
+@cache_for(get_data_version)
+def get_occupancy(version):  # pylint: disable=W0613
+    """
+    Returns presence time of day histograms of users and whole company.
+
+    Computed once per version of presence data, returns dict with
+    Occupancy.averages() of each user in 'users' and of all users in
+    'company'.
+    """
+    company = Occupancy()
+    users = {}
+    for user_id in get_user_ids():
+        user = Occupancy()
+        for date, row in get_user_data(user_id).items():
+            if 'intervals' in row:
+                intervals = row['intervals'].union()
+            else:
+                intervals = [(seconds_since_midnight(row['start']),
+                              seconds_since_midnight(row['end']))]
+            for start, end in intervals:
+                user.add(date, start, end)
+                company.add(date, start, end)
+        users[user_id] = user.averages()
+
+    return {'users': users, 'company': company.averages()}
+
+
+@cache_updates(get_data)
+def update_sketches(data, version, sketches):
+    """
+    Returns quantile sketches of presence data.
+
+    Sketches of incrementally loaded data are updated with its changes.
+    """
+    if sketches is not None and data.changes is not None and \
+            data.base_version == version:
+        return sketches.updated(data.changes)
+    return PresenceSketches.build(data.items())
+
+
+@cache_for(get_data_version)
+def build_sketches(version):  # pylint: disable=W0613
+    """
+    Returns quantile sketches of presence data of indexed storage backend.
+    """
+    return PresenceSketches.build(
+        (user_id, get_user_data(user_id)) for user_id in get_user_ids())
+
+
+def get_sketches():
+    """
+    Returns quantile sketches of presence data served.
+    """
+    if get_storage().indexed:
+        return build_sketches()
+    return update_sketches()
+
+
+@cache_updates(get_data)
+def update_anomalies(data, version, anomalies):
+    """
+    Returns anomaly statistics of presence data.
+
+    Statistics of incrementally loaded data are updated with its changes
+    and newly rejected rows; after full load they are rebuilt by walking
+    all data.
+    """
+    if anomalies is not None and data.changes is not None and \
+            data.base_version == version:
+        return anomalies.updated(data.changes,
+                                 data.rejected[anomalies.checked:])
+    return PresenceAnomalies.build(data.items(), data.rejected)
+
+
+@cache_for(get_data_version)
+def build_anomalies(version):  # pylint: disable=W0613
+    """
+    Returns anomaly statistics of presence data of indexed storage backend.
+
+    Indexed backends do not keep rows rejected while reading users, so
+    rows ending before start are not reported for them.
+    """
+    return PresenceAnomalies.build(
+        (user_id, get_user_data(user_id)) for user_id in get_user_ids())
+
+
+def get_anomalies():
+    """
+    Returns anomaly statistics of presence data served.
+    """
+    if get_storage().indexed:
+        return build_anomalies()
+    return update_anomalies()
+
+
+@cache_for(get_data_version)
+def get_anomalies_payload(version, mimetype=JSON):  # pylint: disable=W0613
+    """
+    Returns report of anomalies, serialized in given format.
+
+    Report is kept until version of presence data changes.
+    """
+    return Serialized(encode(get_anomalies().report(), mimetype))
+
+
+def presence_quantiles(quantiles):
+    """
+    Formats PresenceSketches.quantiles() as rows of weekday and p10, median
+    and p90 of start, end and duration (in seconds).
+    """
+    result = [['Weekday'] + [
+        '%s %s' % (metric.capitalize(), name)
+        for metric in METRICS for name in ('p10', 'median', 'p90')
+    ]]
+    for weekday in sorted(quantiles):
+        result.append([calendar.day_abbr[weekday]] + [
+            value for metric in METRICS
+            for value in quantiles[weekday][metric]
+        ])
+    return result
+
+
+def warm_up(workers=0, max_age=None):
+    """
+    Load CSV and XML files and pre-serialize chart payloads of all users.
+
+    With max_age given, files are reloaded only when cached data is at
+    least that many seconds old, so processes sharing cache backend do not
+    reload what other one just did. Returns number of serialized payloads.
+    """
+    loaders = [get_users]
+    if not get_storage().indexed:
+        loaders.append(get_data)
+    for loader in loaders:
+        age = loader.age()
+        if max_age is None or age is None or age >= max_age:
+            loader.refresh()
+    get_occupancy()
+    get_sketches()
+    get_anomalies_payload(JSON)
+
+    jobs = [(name, user_id) for user_id in get_user_ids()
+            for name in PAYLOADS]
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda job: get_payload(job[0], job[1], JSON), jobs)
+        finally:
+            pool.close()
+    else:
+        for name, user_id in jobs:
+            get_payload(name, user_id, JSON)
+
+    return len(jobs)
+
+
+def start_warm_up(workers=0, interval=None):
+    """
+    Run warm_up() in background thread.
+
+    READY is cleared till the first warm-up is done. With interval given
+    warm-up is repeated every interval seconds, so data is reloaded before
+    cache expires. Repeated warm-ups wait for interval since data was last
+    stored by any process, which aligns processes sharing cache backend.
+    """
+    READY.clear()
+
+    def run():
+        """ Warm-up loop """
+        while True:
+            start = time.time()
+            try:
+                count = warm_up(workers, interval)
+            except Exception:  # pylint: disable=W0703
+                log.exception('Warm-up failed')
+            else:
+                log.info('Warmed up %d payloads in %.2fs',
+                         count, time.time()-start)
+            READY.set()
+
+            if not interval:
+                break
+            ages = [get_users.age(), get_data.age()]
+            age = max([age for age in ages if age is not None] or [0])
+            time.sleep(max(1, interval - age))
+
+    thread = Thread(target=run, name='warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def reload_data(targets=RELOAD_TARGETS, full=False):
+    """
+    Reloads presence data and/or users, regardless of cache expiry.
+
+    New data is swapped into cache only after it is fully loaded, so
+    requests keep being served from the old one meanwhile. With full set,
+    files are parsed from scratch instead of reusing previous load.
+    Returns load duration and row counts of each target.
+    """
+    with RELOAD_LOCK:
+        report = {}
+        if 'data' in targets:
+            start = time.time()
+            if full:
+                clear_caches()
+            if get_storage().indexed:
+                rows = None
+            else:
+                rows = get_data.refresh().rows()
+            report['data'] = {
+                'seconds': round(time.time() - start, 3),
+                'users': len(get_user_ids()),
+                'rows': rows,
+            }
+        if 'users' in targets:
+            start = time.time()
+            users = get_users.refresh()
+            report['users'] = {
+                'seconds': round(time.time() - start, 3),
+                'rows': len(users),
+            }
+        log.info('Reloaded %s', report)
+        return report
+
+
+def start_reload(targets=RELOAD_TARGETS, full=False):
+    """
+    Run reload_data() in background thread.
+    """
+    def run():
+        """ Reload, logging failures """
+        try:
+            reload_data(targets, full)
+        except Exception:  # pylint: disable=W0703
+            log.exception('Reload failed')
+
+    thread = Thread(target=run, name='reload')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def handle_sighup(signum, frame):  # pylint: disable=W0613
+    """
+    Signal handler reloading presence data and users in background.
+    """
+    log.info('Reloading on SIGHUP')
+    return start_reload()
+
+
+def get_versions():
+    """
+    Returns versions of presence data and users being served.
+    """
+    return get_data_version(), get_users().version
+
+
+def version_id(versions):
+    """
+    Returns short identifier of given versions.
+    """
+    return '%08x' % (hash(repr(versions)) & 0xffffffff)
+
+
+@cache_for(get_data_version)
+def get_user_digests(version):  # pylint: disable=W0613
+    """
+    Returns hash of presence entries of each user.
+
+    Returns None for indexed storage backends, which would have to read
+    all users for it.
+    """
+    if get_storage().indexed:
+        return None
+    return {
+        user_id: hash(tuple(sorted(
+            (date, row['start'], row['end'], repr(row.get('intervals')))
+            for date, row in rows.items()
+        )))
+        for user_id, rows in get_data().items()
     }
+
+
+def changed_users(old_digests, new_digests):
+    """
+    Returns sorted ids of users whose presence entries differ, or None
+    when it is not known.
+    """
+    if old_digests is None or new_digests is None:
+        return None
+    return sorted(
+        user_id for user_id in set(old_digests) | set(new_digests)
+        if old_digests.get(user_id) != new_digests.get(user_id)
+    )
+
+
+def sse_event(event, event_id, data):
+    """
+    Formats Server-Sent Event with JSON data.
+    """
+    return 'event: %s\nid: %s\ndata: %s\n\n' % (event, event_id, dumps(data))
+
+
+def version_events(last_id=None, interval=5, max_age=55):
+    """
+    Generates Server-Sent Events announcing changes of served data.
+
+    First event is 'version' with current version id, or 'changed' if
+    client last saw other one (last_id). Then versions are checked every
+    interval seconds and 'changed' event is sent when they differ, with
+    ids of users whose data changed (null if unknown) and flag telling
+    whether users list changed. Stream ends after max_age seconds,
+    clients reconnect by themselves.
+    """
+    versions = get_versions()
+    digests = get_user_digests()
+    event_id = version_id(versions)
+
+    yield 'retry: 1000\n\n'
+    if last_id and last_id != event_id:
+        yield sse_event('changed', event_id,
+                        {'version': event_id, 'users': None,
+                         'users_changed': True})
+    else:
+        yield sse_event('version', event_id, {'version': event_id})
+
+    deadline = time.time() + max_age
+    while time.time() + interval <= deadline:
+        time.sleep(interval)
+        new_versions = get_versions()
+        if new_versions == versions:
+            continue
+
+        new_digests = get_user_digests()
+        event_id = version_id(new_versions)
+        yield sse_event('changed', event_id, {
+            'version': event_id,
+            'users': changed_users(digests, new_digests),
+            'users_changed': new_versions[1] != versions[1],
+        })
+        versions, digests = new_versions, new_digests
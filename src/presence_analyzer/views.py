@@ -3,18 +3,87 @@
 Defines views.
 """
 
-import calendar
-from flask import redirect, render_template, url_for
+from hmac import compare_digest
+from json import dumps
+from datetime import datetime
+from flask import Response, abort, g, redirect, render_template, \
+    request, url_for
 from jinja2.exceptions import TemplateNotFound
+from werkzeug.wsgi import ClosingIterator
 
 from presence_analyzer.main import app
-from presence_analyzer.utils import jsonify, get_data, \
-    mean, group_by_weekday, get_start_end_mean_time, get_users
+from presence_analyzer import export
+from presence_analyzer.admission import get_controller
+from presence_analyzer.decorators import coalesce
+from presence_analyzer.helpers import Slots, to_bytes
+from presence_analyzer.utils import jsonify, get_user_data, get_payload, \
+    get_user_ids, get_users, version_events, response_format, \
+    encode_records, get_occupancy, presence_hours, get_sketches, \
+    presence_quantiles, get_ingest_stats, response_version, data_cached, \
+    reload_data, get_anomalies_payload, PAYLOADS, READY, RELOAD_TARGETS
 
 import logging
 
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
+# API endpoints not subject to admission control; event streams are
+# bounded by EVENT_STREAMS instead
+UNLIMITED_ENDPOINTS = ('ready_view', 'events_view', 'admin_reload_view')
+
+# open streams of /api/v1/events, each holds a server thread
+EVENT_STREAMS = Slots()
+
+
+@app.before_request
+def admit_request():
+    """
+    Rate limits API requests and bounds number of them processed at once.
+
+    Requests which can be served without loading presence data are let in
+    before those which would load it.
+    """
+    controller = get_controller(app.config)
+    if controller is None or not request.path.startswith('/api/') or \
+            request.endpoint in UNLIMITED_ENDPOINTS:
+        return None
+
+    wait = controller.limit(request.remote_addr, request.endpoint)
+    if wait:
+        log.debug('Rate limit of %s exceeded', request.remote_addr)
+        return Response('Too many requests', status=429, headers={
+            'Retry-After': controller.retry_after(wait)})
+
+    if not controller.acquire(priority=data_cached()):
+        return Response('Service unavailable', status=503, headers={
+            'Retry-After': controller.retry_after()})
+    g.admission = controller
+    return None
+
+
+@app.after_request
+def hold_request(response):
+    """
+    Keeps slot taken by admit_request() until streamed response is sent,
+    as its content is only computed then.
+    """
+    controller = g.get('admission')
+    if controller is not None and response.is_streamed:
+        del g.admission
+        response.response = ClosingIterator(response.response,
+                                            controller.release)
+    return response
+
+
+@app.teardown_request
+def release_request(exception=None):  # pylint: disable=W0613
+    """
+    Releases slot taken by admit_request(), unless hold_request() passed
+    it to streamed response.
+    """
+    controller = g.pop('admission', None)
+    if controller is not None:
+        controller.release()
+
 
 @app.route('/')
 def mainpage():
@@ -48,53 +117,215 @@ def users_view():
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
+@coalesce(response_version)
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    if not get_user_data(user_id):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    return result
+    return get_payload('mean_time_weekday', user_id, response_format())
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
 @jsonify
+@coalesce(response_version)
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    if not get_user_data(user_id):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return get_payload('presence_weekday', user_id, response_format())
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
 @jsonify
+@coalesce(response_version)
 def presence_start_end_view(user_id):
     """
     Returns start-end presence of given user grouped by weekday.
     """
-    data = get_data()
+    if not get_user_data(user_id):
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return get_payload('presence_start_end', user_id, response_format())
+
+
+@app.route('/api/v1/presence_quantiles/<int:user_id>', methods=['GET'])
+@jsonify
+@coalesce(response_version)
+def presence_quantiles_view(user_id):
+    """
+    Returns p10, median and p90 of start, end and duration of given user's
+    presence grouped by weekday.
+    """
+    quantiles = get_sketches().quantiles(user_id)
+    if not quantiles:
+        log.debug('User %s not found!', user_id)
+        return []
 
-    try:
-        result = get_start_end_mean_time(data[user_id])
-    except KeyError:
+    return presence_quantiles(quantiles)
+
+
+@app.route('/api/v1/presence_hours', methods=['GET'],
+           defaults={'user_id': None})
+@app.route('/api/v1/presence_hours/<int:user_id>', methods=['GET'])
+@jsonify
+@coalesce(response_version)
+def presence_hours_view(user_id):
+    """
+    Returns mean presence in 15 minute bins of the day, by weekday.
+
+    Values are mean number of people present, so for a single user it is
+    a fraction of days the user was present. Without user_id histogram of
+    whole company is returned.
+    """
+    occupancy = get_occupancy()
+    if user_id is None:
+        return presence_hours(occupancy['company'])
+
+    if user_id not in occupancy['users']:
         log.debug('User %s not found!', user_id)
         return []
 
-    return result
+    return presence_hours(occupancy['users'][user_id])
+
+
+@app.route('/api/v1/bulk/<string:name>', methods=['GET'])
+def bulk_view(name):
+    """
+    Streams chart payloads of many users (all by default).
+
+    Users may be selected with user_id query parameters.
+    """
+    if name not in PAYLOADS:
+        return render_template('404.html'), 404
+
+    user_ids = request.args.getlist('user_id', type=int) or \
+        sorted(get_user_ids())
+    mimetype = response_format()
+    records = (
+        (user_id, get_payload(name, user_id, mimetype))
+        for user_id in user_ids if get_user_data(user_id)
+    )
+    return Response(encode_records(records, mimetype), mimetype=mimetype)
+
+
+def date_arg(name):
+    """
+    Returns date from YYYY-MM-DD query parameter, aborts with 400 if invalid.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+
+@app.route('/api/v1/export.<string:extension>', methods=['GET'])
+def export_view(extension):
+    """
+    Streams daily presence entries as CSV or XLSX file.
+
+    Users may be selected with user_id query parameters and dates with
+    start and end ones (YYYY-MM-DD, inclusive).
+    """
+    if extension not in export.FORMATS:
+        return render_template('404.html'), 404
+    package = export.missing_package(extension)
+    if package is not None:
+        message = '%s is required for .%s export' % (package, extension)
+        return Response(message, status=501)
+
+    mimetype, chunks = export.FORMATS[extension]
+    rows = export.export_rows(request.args.getlist('user_id', type=int),
+                              date_arg('start'), date_arg('end'))
+    return Response(chunks(rows), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=presence.%s' % extension,
+    })
+
+
+@app.route('/api/v1/ingest_stats', methods=['GET'])
+@jsonify
+def ingest_stats_view():
+    """
+    Returns numbers of accepted and rejected rows of presence data.
+    """
+    return get_ingest_stats()
+
+
+@app.route('/api/v1/anomalies', methods=['GET'])
+@jsonify
+def anomalies_view():
+    """
+    Returns anomalies found in presence data: days longer than 16 hours,
+    rows ending before start (not known with indexed storage backends),
+    shifts of start time and missing weekdays.
+    """
+    return get_anomalies_payload(response_format())
+
+
+@app.route('/api/v1/admin/reload', methods=['POST'])
+@jsonify
+def admin_reload_view():
+    """
+    Reloads presence data and users, answers with load durations and row
+    counts.
+
+    Requires "Authorization: Bearer <ADMIN_TOKEN>" header, the endpoint is
+    disabled without ADMIN_TOKEN. Reloaded parts are chosen with "target"
+    parameters (data, users; both by default), "full=1" parses files from
+    scratch.
+    """
+    token = app.config.get('ADMIN_TOKEN')
+    if not token:
+        abort(404)
+    authorization = request.headers.get('Authorization', '')
+    if not compare_digest(to_bytes(authorization),
+                          'Bearer %s' % to_bytes(token)):
+        abort(401)
+
+    targets = request.values.getlist('target') or RELOAD_TARGETS
+    if not set(targets) <= set(RELOAD_TARGETS):
+        abort(400)
+    return reload_data(targets, full=request.values.get('full') == '1')
+
+
+@app.route('/api/v1/ready', methods=['GET'])
+def ready_view():
+    """
+    Readiness probe, answers with 503 until warm-up is done.
+    """
+    ready = READY.is_set()
+    return Response(dumps({'ready': ready}), status=200 if ready else 503,
+                    mimetype='application/json')
+
+
+@app.route('/api/v1/events', methods=['GET'])
+def events_view():
+    """
+    Stream of Server-Sent Events announcing presence data changes.
+
+    At most EVENTS_MAX_STREAMS streams are open at once, further clients
+    get 204, which makes EventSource stop reconnecting.
+    """
+    if not EVENT_STREAMS.take(app.config.get('EVENTS_MAX_STREAMS', 12)):
+        log.debug('Too many event streams')
+        return Response(status=204)
+
+    events = version_events(
+        last_id=request.headers.get('Last-Event-ID'),
+        interval=app.config.get('EVENTS_INTERVAL', 5),
+        max_age=app.config.get('EVENTS_MAX_AGE', 55),
+    )
+    return Response(ClosingIterator(events, EVENT_STREAMS.release),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})